@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+
+import threading
+import time
+import weakref
+from urllib.parse import urlparse
+
+user_agent_default = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Safari/537.36'
+timeout_default = 10
+pool_connections_default = 32
+pool_maxsize_default = 8
+host_rate_default = 4.0
+host_burst_default = 8
+host_concurrency_default = 2
+robots_default = 'delay'
+robots_ttl_default = 86400
+robots_timeout = 5
+crawl_global_concurrency_default = 16
+
+redis_strkey_robots = 'robots'
+
+session = None
+session_lock = threading.Lock()
+session_variables = {}
+session_redis = None
+crawl_slots = None
+
+host_limiters = {}
+host_limiters_lock = threading.Lock()
+
+class DisallowedByRobots(IOError):
+    pass
+
+class HostLimiter:
+
+    def __init__(self, rate, burst, concurrency, robots):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.robots = robots
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            self.wait()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self):
+        self.slots.release()
+
+def make_session(user_agent, timeout, pool_connections, pool_maxsize):
+    # requests is imported with the first session, so that commands which
+    # never go online, such as printing to stdout, do not load it.
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class Session(requests.Session):
+
+        def request(self, method, url, **kwargs):
+            if kwargs.get('timeout') is None:
+                kwargs['timeout'] = timeout
+            return super().request(method, url, **kwargs)
+
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({ 'Cache-Control': 'no-cache', 'User-Agent': user_agent })
+    return session
+
+def configure(variables, redis=None):
+    global session
+    global session_variables
+    global session_redis
+    global crawl_slots
+    with session_lock:
+        session_variables = dict(variables) if variables is not None else {}
+        session_redis = redis
+        crawl_slots = None
+        if session is not None:
+            session.close()
+            session = None
+    with host_limiters_lock:
+        host_limiters.clear()
+
+def get_session():
+    global session
+    with session_lock:
+        if session is None:
+            session = make_session(
+                session_variables.get('http_user_agent', user_agent_default),
+                float(session_variables.get('http_timeout', timeout_default)),
+                int(session_variables.get('http_pool_connections', pool_connections_default)),
+                int(session_variables.get('http_pool_maxsize', pool_maxsize_default)))
+        return session
+
+def get_crawl_slots():
+    # The slots are shared by every site, so they are sized from the global
+    # variables only and rebuilt when the client is configured again.
+    global crawl_slots
+    with session_lock:
+        if crawl_slots is None:
+            crawl_slots = threading.BoundedSemaphore(int(session_variables.get('crawl_global_concurrency', crawl_global_concurrency_default)))
+        return crawl_slots
+
+def get_robots(origin):
+    from urllib.robotparser import RobotFileParser
+    robots_key = redis_strkey_robots + '+' + origin
+    text = None
+    if session_redis is not None:
+        text = session_redis.get(robots_key)
+    if text is None:
+        text = ''
+        try:
+            res = get_session().get(origin + '/robots.txt', timeout=robots_timeout)
+            if res.status_code == 200:
+                text = res.text
+        except Exception:
+            pass
+        if session_redis is not None:
+            session_redis.set(robots_key, text, ex=int(session_variables.get('http_robots_ttl', robots_ttl_default)))
+    robots = RobotFileParser()
+    robots.parse(text.splitlines())
+    return robots
+
+def get_host_limiter(link):
+    url = urlparse(link)
+    origin = url.scheme + '://' + url.netloc.lower()
+    with host_limiters_lock:
+        limiter = host_limiters.get(origin)
+    if limiter is not None:
+        return limiter
+
+    rate = float(session_variables.get('http_host_rate', host_rate_default))
+    burst = float(session_variables.get('http_host_burst', host_burst_default))
+    concurrency = int(session_variables.get('http_host_concurrency', host_concurrency_default))
+    robots = None
+    if session_variables.get('http_robots', robots_default) != 'ignore':
+        robots = get_robots(origin)
+        delay = robots.crawl_delay(get_session().headers['User-Agent'])
+        if delay is not None and float(delay) > 0:
+            rate = min(rate, 1 / float(delay))
+            burst = 1
+
+    with host_limiters_lock:
+        return host_limiters.setdefault(origin, HostLimiter(rate, burst, concurrency, robots))
+
+def hold_until_closed(res, limiter):
+    released = threading.Lock()
+
+    def release():
+        if released.acquire(blocking=False):
+            limiter.release()
+
+    close = res.close
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            release()
+
+    # A streamed body is still being downloaded after request returns, so
+    # the host slot is given back when the response is closed, or at the
+    # latest when it is garbage collected.
+    res.close = close_and_release
+    weakref.finalize(res, release)
+    return res
+
+def request(method, link, **kwargs):
+    limiter = get_host_limiter(link)
+    if limiter.robots is not None and session_variables.get('http_robots', robots_default) == 'obey':
+        if not limiter.robots.can_fetch(get_session().headers['User-Agent'], link):
+            raise DisallowedByRobots('{} is disallowed by robots.txt'.format(link))
+    limiter.acquire()
+    try:
+        res = get_session().request(method, link, **kwargs)
+    except BaseException:
+        limiter.release()
+        raise
+    if not kwargs.get('stream', False):
+        limiter.release()
+        return res
+    return hold_until_closed(res, limiter)
+
+def get(link, **kwargs):
+    return request('GET', link, **kwargs)
+
+def head(link, **kwargs):
+    kwargs.setdefault('allow_redirects', True)
+    return request('HEAD', link, **kwargs)
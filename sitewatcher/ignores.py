@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import re
+from urllib.parse import urlsplit
+
+ignore_prefix_host = 'host:'
+ignore_prefix_regex = 're:'
+
+def get_rule_error(rule):
+    if rule.startswith(ignore_prefix_regex):
+        try:
+            re.compile(rule[len(ignore_prefix_regex):])
+        except re.error as e:
+            return 'invalid regular expression: {}'.format(e)
+    return None
+
+class IgnoreMatcher:
+
+    def __init__(self, rules, base=None):
+        self.base = base
+        self.prefixes = set()
+        self.hosts = set()
+        patterns = []
+        for rule in rules if rules is not None else []:
+            if rule.startswith(ignore_prefix_host):
+                self.hosts.add(rule[len(ignore_prefix_host):].strip().lower())
+            elif rule.startswith(ignore_prefix_regex):
+                # Rules stored before they were validated are skipped.
+                if get_rule_error(rule) is not None:
+                    continue
+                patterns.append('(?:' + rule[len(ignore_prefix_regex):] + ')')
+            else:
+                self.prefixes.add(rule)
+        self.lengths = sorted(set(len(p) for p in self.prefixes))
+        self.regex = re.compile('|'.join(patterns), re.IGNORECASE) if len(patterns) > 0 else None
+
+    def match_host(self, link_lower):
+        host = urlsplit(link_lower).hostname
+        while host is not None and len(host) > 0:
+            if host in self.hosts:
+                return True
+            dot = host.find('.')
+            host = host[dot + 1:] if dot >= 0 else None
+        return False
+
+    def matches(self, link, link_lower=None):
+        if link_lower is None:
+            link_lower = link.lower()
+        for n in self.lengths:
+            if n > len(link_lower):
+                break
+            if link_lower[:n] in self.prefixes:
+                return True
+        if len(self.hosts) > 0 and self.match_host(link_lower):
+            return True
+        if self.regex is not None and self.regex.search(link) is not None:
+            return True
+        if self.base is not None:
+            return self.base.matches(link, link_lower)
+        return False
+
+def compile_ignores(rules, base=None):
+    return IgnoreMatcher(rules, base)
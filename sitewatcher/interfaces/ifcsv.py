@@ -1,65 +1,98 @@
 #!/usr/bin/python3
 
+import codecs
 import csv
 import hashlib
-import requests
-import sys
 from urllib.parse import urlparse
 
 from sitewatcher.interfaces.ifsource import BaseSource
 
-class Source(BaseSource):
-
-    def get_file(self, link):
+csv_chunk_bytes = 65536
 
-        res = None
-        try:
-            res = requests.get(link, timeout=10)
-        except requests.exceptions.RequestException as e:
-            print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
-            logger.warning('{}: failed to fetch {}'.format(self.name, link))
-            logger.debug(e)
-            return None
-        except Exception as e:
-            print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
-            logger.warning('{}: failed to fetch {}'.format(self.name, link))
-            logger.debug(e)
-            return None
+class Source(BaseSource):
 
-        if res.status_code >= 400:
-            print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
-            logger.warning('{}: failed to fetch {}. Status code={}'.format(self.name, link, res.status_code))
-            return None
+    def get_encoding(self, res):
+        return res.encoding if res.encoding is not None and res.encoding != 'ISO-8859-1' else 'utf-8'
 
-        enc = res.encoding if res.encoding != 'ISO-8859-1' else None
-        text = res.content.decode(enc)
+    def iter_lines(self, chunks, encoding):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        pending = ''
+        for chunk in chunks:
+            pending += decoder.decode(chunk)
+            lines = pending.splitlines(True)
+            pending = ''
+            # The last line stays pending while it may still grow, including
+            # a trailing '\r' whose '\n' can arrive with the next chunk.
+            if len(lines) > 0 and (lines[-1].endswith('\r') or lines[-1].splitlines()[0] == lines[-1]):
+                pending = lines.pop()
+            for line in lines:
+                yield line.splitlines()[0]
+        pending += decoder.decode(b'', True)
+        yield from pending.splitlines()
 
-        return text
+    def is_link(self, column):
+        # Only cells containing '://' can have both a scheme and a netloc.
+        if '://' not in column:
+            return False
+        url_object = urlparse(column)
+        return len(url_object.scheme) > 0 and len(url_object.netloc) > 0
 
-    def get_links(self, text):
-        links = {}
-        lines = csv.reader(text.splitlines())
-        for line in lines:
+    def get_links(self, lines, ignores=None):
+        for line in csv.reader(lines):
             text_list = []
             link_list = []
             for column in line:
-                url_object = urlparse(column)
-                if len(url_object.scheme) > 0 and len(url_object.netloc) > 0:
+                if self.is_link(column):
                     link_list.append(column)
                 else:
                     text_list.append(column)
             tag = '::'.join(text_list)
             for link in link_list:
+                if self.is_ignored(link, ignores):
+                    continue
                 hash = hashlib.md5((self.resid + link + tag).encode()).hexdigest()
-                links.update({hash: { 'site': self.resid, 'parent': self.resid, 'name': '', 'link': link, 'tag': tag }})
-        return links
+                yield hash, { 'site': self.resid, 'parent': self.resid, 'name': '', 'link': link, 'tag': tag }
+
+    def iter_links(self, link, res, page, ignores):
+        digest = hashlib.blake2b(digest_size=16)
+
+        def iter_chunks():
+            for chunk in res.iter_content(chunk_size=csv_chunk_bytes):
+                digest.update(chunk)
+                yield chunk
+
+        try:
+            yield from self.get_links(self.iter_lines(iter_chunks(), self.get_encoding(res)), ignores)
+        finally:
+            res.close()
+
+        digest = digest.hexdigest() if self.fingerprint else None
+        unchanged = digest is not None and page is not None and page.get('digest') == digest
+        if unchanged:
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+        self.count_page(unchanged)
+        self.set_page(link, res, None, digest=digest)
+
+    def iter_link_set(self, hash, link, depth, ignores):
+        page = self.get_page(link)
+        res = self.fetch(link, self.get_page_headers(page), stream=True)
+        if res is None:
+            return None
+
+        if page is not None and res.status_code == 304:
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+            res.close()
+            self.count_page(True)
+            self.set_page(link, res, None, page)
+            return iter(())
+
+        return self.iter_links(link, res, page, ignores)
 
     def make_link_set(self, hash, link, depth, ignores):
-        text = self.get_file(link)
-        if text is None:
+        links = self.iter_link_set(hash, link, depth, ignores)
+        if links is None:
             return None
-        else:
-            return self.get_links(text)
+        return dict(links)
 
     def use_tag_title(self):
         return True
@@ -1,14 +1,78 @@
 #!/usr/bin/python3
 
+import asyncio
 import hashlib
 import re
-import requests
 import sys
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit, urlunsplit
 
+from sitewatcher import httpclient
 from sitewatcher.interfaces.ifsource import BaseSource
 
+crawl_concurrency_default = 4
+
+# html.parser defines the stored link hashes. It only builds <a> elements
+# when the anchors of a document are closed before any enclosing element,
+# and gives the same tags as the full tree then. lxml follows HTML5 tree
+# rules and gives other tags for nested or unclosed anchors, so switching a
+# live site to it changes hashes and reports those links as added and
+# removed.
+html_parser_default = 'html.parser'
+html_parsers = {
+    'html.parser': ('html.parser', True),
+    'lxml': ('lxml', True)
+}
+
+strain_raw_text = re.compile(rb'<!--.*?-->|<(script|style|textarea|title)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+strain_tags = re.compile(rb'<(/?)([A-Za-z][^\s/>]*)(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/?)>')
+strain_void_tags = frozenset([b'area', b'base', b'br', b'col', b'embed', b'hr', b'img', b'input', b'link', b'meta', b'param', b'source', b'track', b'wbr'])
+
+ref_control_chars = re.compile('[\x00-\x1f]')
+ref_inline_tags = re.compile('<.*?>')
+ref_skipped_prefixes = ('#', 'mailto:', 'tel:', 'javascript:')
+title_spaces = re.compile('[　 ]+')
+
+def is_strainable(content):
+    # Without the elements around it, an anchor left open is closed by the
+    # end of the document instead of the end tag of an enclosing element,
+    # and takes the text after that element in. Such documents are parsed
+    # in full.
+    if isinstance(content, str):
+        content = content.encode('utf-8', 'replace')
+    depth = 0
+    opened = []
+    for m in strain_tags.finditer(strain_raw_text.sub(b'', content)):
+        name = m.group(2).lower()
+        if name == b'a':
+            if m.group(1) == b'':
+                depth += 1
+            elif depth > 0:
+                depth -= 1
+                while len(opened) > 0 and opened[-1][0] > depth:
+                    opened.pop()
+        elif depth == 0 or name in strain_void_tags:
+            continue
+        elif m.group(1) == b'':
+            if m.group(3) == b'':
+                opened.append((depth, name))
+        else:
+            names = [n for d, n in opened]
+            if name not in names:
+                return False
+            del opened[len(names) - 1 - names[::-1].index(name):]
+    return True
+
+def normalize_link(link):
+    url = urlsplit(link)
+    scheme = url.scheme.lower()
+    netloc = url.netloc.lower()
+    if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    path = url.path if len(url.path) > 0 else '/'
+    return urlunsplit((scheme, netloc, path, url.query, ''))
+
 class Source(BaseSource):
 
     def get_references(self, bs, parent_hash, parent_link, links, ignores):
@@ -17,33 +81,21 @@ class Source(BaseSource):
         for t in bs.find_all('a'):
             ref = t.get('href')
             if ref is not None:
-                ref = ''.join(filter(lambda c: c >= ' ', ref))
-                ref = re.sub('<.*?>', '', ref)
+                ref = ref_control_chars.sub('', ref)
+                ref = ref_inline_tags.sub('', ref)
                 ref = ref.strip()
 
                 ref_lower = ref.lower()
-                if ref_lower.startswith('#'):
-                    pass
-                elif ref_lower.startswith('mailto:'):
-                    pass
-                elif ref_lower.startswith('tel:'):
-                    pass
-                elif ref_lower.startswith('javascript:'):
+                if ref_lower.startswith(ref_skipped_prefixes):
                     pass
                 else:
                     if parent_link is not None:
                         ref = urljoin(parent_link, ref)
                         ref_lower = ref.lower()
-                    is_ignored = False
-                    if ignores is not None:
-                        for i in ignores:
-                            if ref_lower.startswith(i):
-                                is_ignored = True
-                                break
-                    if is_ignored is False:
+                    if ignores is None or not ignores.matches(ref, ref_lower):
                         cs = t.strings
                         if cs is not None:
-                            title = re.sub('[　 ]+', ' ', '::'.join(filter(lambda x: len(x) > 0, [s.strip() for s in cs])))
+                            title = title_spaces.sub(' ', '::'.join([x for x in (c.strip() for c in cs) if len(x) > 0]))
                         tag = title + (' ' if len(title) > 0 else '') + '---- ' + ref
                         hash = hashlib.md5((self.resid + tag).encode()).hexdigest()
                         if ref in child_links:
@@ -58,33 +110,57 @@ class Source(BaseSource):
                             child_links.update({ref: hash})
         return children
 
-    def make_link_set_recursive(self, hash, link, depth, links, ignores):
-
-        res = None
-        headers = { 'Cache-Control': 'no-cache', 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Safari/537.36' }
+    def make_soup(self, content, backend=None):
+        if backend is None:
+            backend = self.variables.get('html_parser', html_parser_default)
+        features, strained = html_parsers.get(backend, html_parsers[html_parser_default])
+        parse_only = SoupStrainer('a') if strained and (features != 'html.parser' or is_strainable(content)) else None
         try:
-            res = requests.get(link, headers=headers, timeout=10)
-        except requests.exceptions.RequestException as e:
-            print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
-            self.logger.warning('{}: failed to fetch {}'.format(self.name, link))
-            self.logger.debug(e)
-            return None
-        except Exception as e:
-            print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
-            self.logger.warning('{}: failed to fetch {}'.format(self.name, link))
-            self.logger.debug(e)
+            return BeautifulSoup(content, features, parse_only=parse_only)
+        except FeatureNotFound:
+            self.logger.warning('{}: html parser {} is not available'.format(self.name, backend))
+            return BeautifulSoup(content, 'html.parser', parse_only=parse_only)
+
+    def get_children(self, hash, link, ignores):
+        page = self.get_page(link)
+        res = self.fetch(link, self.get_page_headers(page))
+        if res is None:
             return None
 
-        if res.status_code >= 400:
-            print('{}: failed to fetch {}. Status code={}'.format(self.name, link, res.status_code), file=sys.stderr)
-            self.logger.warning('{}: failed to fetch {}. Status code={}'.format(self.name, link, res.status_code))
+        if self.is_page_unchanged(page, res):
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+            self.set_page(link, res, page['links'], page)
+            return self.get_page_links(page, hash)
+
+        bs = self.make_soup(res.content)
+        children = self.get_references(bs, hash, link, None, ignores)
+        self.set_page(link, res, children)
+        return children
+
+    def get_children_once(self, hash, link, depth, ignores):
+        key = normalize_link(link)
+        visited = self.visited.get(key)
+        if visited is None:
+            children = self.get_children(hash, link, ignores)
+            self.visited[key] = { 'children': children, 'depth': depth }
+            return children, True
+
+        self.deduplicated += 1
+        expand = depth > visited['depth']
+        if expand:
+            visited['depth'] = depth
+        if visited['children'] is None:
+            return None, False
+        return { h: dict(v, parent=hash) for h, v in visited['children'].items() }, expand
+
+    def make_link_set_recursive(self, hash, link, depth, links, ignores):
+        children, expand = self.get_children_once(hash, link, depth, ignores)
+        if children is None:
             return None
 
-        bs = BeautifulSoup(res.content, 'html.parser')
-        children = self.get_references(bs, hash, link, links, ignores)
         links.update(children)
 
-        if depth > 1:
+        if depth > 1 and expand:
             for h in children:
                 descendant_links = self.make_link_set_recursive(h, children[h]['link'], depth - 1, links, ignores)
                 if descendant_links is not None:
@@ -92,5 +168,87 @@ class Source(BaseSource):
 
         return links
 
+    def get_children_in_global_slot(self, hash, link, ignores):
+        with httpclient.get_crawl_slots():
+            return self.get_children(hash, link, ignores)
+
+    async def crawl(self, loop, executor, concurrency, root, ignores):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(node):
+            async with semaphore:
+                node['children'] = await loop.run_in_executor(executor, self.get_children_in_global_slot, node['hash'], node['link'], ignores)
+
+        # Breadth-first order reaches every page first at its largest
+        # remaining depth, so later occurrences never need to be expanded.
+        visited = { normalize_link(root['link']): root }
+        level = [root]
+        while len(level) > 0:
+            await asyncio.gather(*[fetch(node) for node in level])
+            next_level = []
+            for node in level:
+                if node['children'] is not None and node['depth'] > 1:
+                    for h, child in node['children'].items():
+                        descendant = { 'hash': h, 'link': child['link'], 'depth': node['depth'] - 1, 'children': None, 'descendants': {} }
+                        node['descendants'][h] = descendant
+                        key = normalize_link(child['link'])
+                        if key in visited:
+                            descendant['same'] = visited[key]
+                            self.deduplicated += 1
+                        else:
+                            visited[key] = descendant
+                            next_level.append(descendant)
+            level = next_level
+
+    def merge_crawled(self, node, links):
+        # Replays the crawl tree depth-first so that the result follows the
+        # same order as make_link_set_recursive.
+        links.update(node['children'])
+        for h in node['children']:
+            descendant = node['descendants'].get(h)
+            if descendant is None:
+                continue
+            if 'same' in descendant:
+                same = descendant['same']
+                if same['children'] is not None:
+                    links.update({ ch: dict(v, parent=h) for ch, v in same['children'].items() })
+            elif descendant['children'] is not None:
+                self.merge_crawled(descendant, links)
+        return links
+
+    def make_link_set_async(self, hash, link, depth, ignores):
+        concurrency = int(self.variables.get('crawl_concurrency', crawl_concurrency_default))
+        root = { 'hash': hash, 'link': link, 'depth': depth, 'children': None, 'descendants': {} }
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                loop.run_until_complete(self.crawl(loop, executor, concurrency, root, ignores))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+        if root['children'] is None:
+            return None
+        return self.merge_crawled(root, {})
+
     def make_link_set(self, hash, link, depth, ignores):
-        return self.make_link_set_recursive(hash, link, depth, {}, ignores)
+        self.visited = {}
+        self.deduplicated = 0
+        if depth > 1 and self.variables.get('crawl_engine') == 'async':
+            links = self.make_link_set_async(hash, link, depth, ignores)
+        else:
+            links = self.make_link_set_recursive(hash, link, depth, {}, ignores)
+        if self.deduplicated > 0:
+            self.logger.info('{}: {} duplicate fetches skipped'.format(self.name, self.deduplicated))
+        return links
+
+if __name__ == '__main__':
+    import logging
+    import pprint
+    if len(sys.argv) > 1:
+        links = {}
+        for i in range(1, len(sys.argv)):
+            links.update(Source('(name)', '(resid)', logging.getLogger()).make_link_set('(hash)', sys.argv[i], 1, None))
+        pprint.pprint(links)
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+import hashlib
+import ijson
+import sys
+from urllib.parse import urljoin
+
+from sitewatcher.interfaces.ifsource import BaseSource, DigestReader
+
+json_items_default = ''
+json_link_default = 'url'
+json_title_default = 'title'
+
+def get_path_value(item, path):
+    value = item
+    for key in path.split('.') if len(path) > 0 else []:
+        if isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            value = value[int(key)]
+        else:
+            return None
+    return value
+
+class Source(BaseSource):
+
+    def get_items_prefix(self):
+        # Paths are dotted keys from the document root to the items array,
+        # which ijson addresses with one more 'item' level.
+        path = self.variables.get('json_items', json_items_default).strip('.')
+        return path + '.item' if len(path) > 0 else 'item'
+
+    def iter_items(self, link, res, page, ignores):
+        link_path = self.variables.get('json_link', json_link_default)
+        title_path = self.variables.get('json_title', json_title_default)
+        reader = DigestReader(res)
+        links = {}
+        try:
+            for item in ijson.items(reader, self.get_items_prefix()):
+                url = get_path_value(item, link_path)
+                if not isinstance(url, str) or len(url) == 0:
+                    continue
+                url = urljoin(link, url.strip())
+                title = get_path_value(item, title_path)
+                title = str(title).strip() if title is not None else ''
+                if self.is_ignored(url, ignores):
+                    continue
+                hash = hashlib.md5((self.resid + url + title).encode()).hexdigest()
+                links.update({hash: { 'site': self.resid, 'parent': self.resid, 'name': title, 'link': url, 'tag': title }})
+                yield hash, links[hash]
+        finally:
+            res.close()
+
+        digest = reader.hexdigest() if self.fingerprint else None
+        unchanged = digest is not None and page is not None and page.get('digest') == digest
+        if unchanged:
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+        self.count_page(unchanged)
+        self.set_page(link, res, links, digest=digest)
+
+    def iter_link_set(self, hash, link, depth, ignores):
+        page = self.get_page(link)
+        res = self.fetch(link, self.get_page_headers(page), stream=True)
+        if res is None:
+            return None
+
+        if page is not None and res.status_code == 304:
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+            res.close()
+            self.count_page(True)
+            self.set_page(link, res, page['links'], page)
+            return iter(self.get_page_links(page, self.resid).items())
+
+        return self.iter_items(link, res, page, ignores)
+
+    def make_link_set(self, hash, link, depth, ignores):
+        links = self.iter_link_set(hash, link, depth, ignores)
+        if links is None:
+            return None
+        return dict(links)
+
+if __name__ == '__main__':
+    import logging
+    import pprint
+    if len(sys.argv) > 1:
+        links = {}
+        for i in range(1, len(sys.argv)):
+            links.update(Source('(name)', '(resid)', logging.getLogger()).make_link_set('(hash)', sys.argv[i], 0, None))
+        pprint.pprint(links)
@@ -5,6 +5,11 @@ class BasePrinter:
     def __init__(self, args=None, variables=None):
         pass
 
+    @property
+    def session(self):
+        from sitewatcher import httpclient
+        return httpclient.get_session()
+
     def print_all(self, targets, debug_mode=False):
         site_name = targets['name']
         site_link = targets['link']
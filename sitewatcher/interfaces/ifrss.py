@@ -8,28 +8,68 @@ from sitewatcher.interfaces.ifsource import BaseSource
 
 class Source(BaseSource):
 
+    def get_entry_id(self, entry):
+        entry_id = entry.get('id')
+        return entry_id if entry_id is not None and len(entry_id) > 0 else entry.get('link')
+
     def make_link_set(self, hash, link, depth, ignores):
+        page = self.get_page(link)
+        res = self.fetch(link, self.get_page_headers(page))
+        if res is None:
+            return None
+
+        if self.is_page_unchanged(page, res):
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+            self.set_page(link, res, page['links'], page, fields={ 'ids': page.get('ids', []) })
+            return self.get_page_links(page, self.resid)
+
         feed = None
         try:
-            feed = feedparser.parse(link)
+            feed = feedparser.parse(res.content, response_headers={ k.lower(): v for k, v in res.headers.items() })
         except Exception as e:
             print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
-            logger.warning('{}: failed to fetch {}'.format(self.name, link))
-            logger.debug(e)
+            self.logger.warning('{}: failed to fetch {}'.format(self.name, link))
+            self.logger.debug(e)
             return None
 
+        # Entries of an append-only feed never change once published, so
+        # processing stops at the first entry that was already seen and the
+        # rest of the window is taken from the previous link set.
+        append_only = self.variables.get('rss_append_only', 'off') == 'on'
+        known_ids = set(page.get('ids', [])) if append_only and page is not None and page.get('links') is not None else None
+
         links = {}
+        ids = []
         for e in feed['entries']:
+            entry_id = self.get_entry_id(e)
+            if known_ids is not None and entry_id in known_ids:
+                break
+            ids.append(entry_id)
             url = e['link']
             title = e['title']
+            if self.is_ignored(url, ignores):
+                continue
             hash = hashlib.md5((self.resid + url + title).encode()).hexdigest()
             links.update({hash: { 'site': self.resid, 'parent': self.resid, 'name': title, 'link': url, 'tag': title }})
+
+        if known_ids is not None and len(ids) < len(feed['entries']):
+            self.logger.debug('{}: {} new entries in {}'.format(self.name, len(ids), link))
+            size = len(feed['entries'])
+            ids.extend(page['ids'][:size - len(ids)])
+            for h, v in self.get_page_links(page, self.resid).items():
+                if len(links) >= size:
+                    break
+                if h not in links:
+                    links.update({h: v})
+
+        self.set_page(link, res, links, fields={ 'ids': ids })
         return links
 
 if __name__ == '__main__':
+    import logging
     import pprint
     if len(sys.argv) > 1:
         links = {}
         for i in range(1, len(sys.argv)):
-            links.update(Source('(name)', '(resid)', None).make_link_set('(hash)', sys.argv[i], 0, None))
+            links.update(Source('(name)', '(resid)', logging.getLogger()).make_link_set('(hash)', sys.argv[i], 0, None))
         pprint.pprint(links)
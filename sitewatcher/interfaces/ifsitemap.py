@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+import gzip
+import hashlib
+import sys
+from xml.etree.ElementTree import iterparse
+
+from sitewatcher.interfaces.ifsource import BaseSource, DigestReader
+
+gzip_magic = b'\x1f\x8b'
+
+class SitemapReader(DigestReader):
+
+    def __init__(self, res):
+        super().__init__(res)
+        self.head = super().read(len(gzip_magic))
+
+    def is_gzip(self):
+        return self.head == gzip_magic
+
+    def read(self, size=-1):
+        if len(self.head) > 0:
+            data, self.head = self.head, b''
+            return data
+        return super().read(size)
+
+# Sitemaps without a namespace are invalid but common, so elements without
+# one are read as well.
+sitemap_namespaces = ('{http://www.sitemaps.org/schemas/sitemap/0.9}', '')
+sitemap_entries = ('url', 'sitemap')
+
+def split_tag(tag):
+    if tag.startswith('{'):
+        namespace, name = tag[1:].split('}', 1)
+        return '{' + namespace + '}', name
+    return '', tag
+
+def parse_sitemap(stream):
+    root = None
+    path = []
+    loc = None
+    lastmod = None
+    for event, elem in iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            path.append(elem.tag)
+            continue
+        path.pop()
+        namespace, name = split_tag(elem.tag)
+        if namespace not in sitemap_namespaces:
+            continue
+        # Only <loc> and <lastmod> directly under an entry count, so that
+        # extensions such as <image:loc> do not replace the page location.
+        if name in ('loc', 'lastmod'):
+            if len(path) == 2 and path[-1] in (namespace + e for e in sitemap_entries):
+                text = elem.text.strip() if elem.text is not None else None
+                if name == 'loc':
+                    loc = text
+                else:
+                    lastmod = text
+        elif name in sitemap_entries and len(path) == 1:
+            if loc is not None and len(loc) > 0:
+                yield name, loc, lastmod
+            loc = None
+            lastmod = None
+            # Entries are dropped from the tree as soon as they are read so
+            # that memory does not grow with the size of the sitemap.
+            root.clear()
+
+class Source(BaseSource):
+
+    def get_record(self, hash, loc):
+        tag = '---- ' + loc
+        return hashlib.md5((self.resid + tag).encode()).hexdigest(), { 'site': self.resid, 'parent': hash, 'name': '', 'link': loc, 'tag': tag }
+
+    def iter_cached(self, hash, page, ignores, visited):
+        yield from self.get_page_links(page, hash).items()
+        for loc, lastmod in page.get('sitemaps', []):
+            yield from self.iter_sitemap(hash, loc, lastmod, ignores, visited)
+
+    def iter_parsed(self, hash, link, lastmod, res, page, ignores, visited):
+        reader = SitemapReader(res)
+        links = {}
+        sitemaps = []
+        try:
+            for kind, loc, mod in parse_sitemap(gzip.GzipFile(fileobj=reader) if reader.is_gzip() else reader):
+                if kind == 'sitemap':
+                    sitemaps.append([loc, mod])
+                elif not self.is_ignored(loc, ignores):
+                    h, v = self.get_record(hash, loc)
+                    links.update({h: v})
+                    yield h, v
+        finally:
+            res.close()
+
+        digest = reader.hexdigest() if self.fingerprint else None
+        unchanged = digest is not None and page is not None and page.get('digest') == digest
+        if unchanged:
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+        self.count_page(unchanged)
+        self.set_page(link, res, links, digest=digest, fields={ 'lastmod': lastmod, 'sitemaps': sitemaps })
+
+        for loc, mod in sitemaps:
+            yield from self.iter_sitemap(hash, loc, mod, ignores, visited)
+
+    def iter_sitemap(self, hash, link, lastmod, ignores, visited):
+        if link in visited:
+            return
+        visited.add(link)
+
+        page = self.get_page(link)
+        if page is not None and lastmod is not None and page.get('lastmod') == lastmod:
+            self.logger.debug('{}: not modified since {} {}'.format(self.name, lastmod, link))
+            self.count_page(True)
+            self.keep_page(link, page)
+            yield from self.iter_cached(hash, page, ignores, visited)
+            return
+
+        res = self.fetch(link, self.get_page_headers(page), stream=True)
+        if res is None:
+            if page is not None:
+                self.keep_page(link, page)
+                yield from self.iter_cached(hash, page, ignores, visited)
+            return
+
+        if page is not None and res.status_code == 304:
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+            res.close()
+            self.count_page(True)
+            self.set_page(link, res, page['links'], page, fields={ 'lastmod': lastmod, 'sitemaps': page.get('sitemaps', []) })
+            yield from self.iter_cached(hash, page, ignores, visited)
+            return
+
+        yield from self.iter_parsed(hash, link, lastmod, res, page, ignores, visited)
+
+    def iter_link_set(self, hash, link, depth, ignores):
+        page = self.get_page(link)
+        res = self.fetch(link, self.get_page_headers(page), stream=True)
+        if res is None:
+            return None
+
+        visited = set([link])
+        if page is not None and res.status_code == 304:
+            self.logger.debug('{}: unchanged {}'.format(self.name, link))
+            res.close()
+            self.count_page(True)
+            self.set_page(link, res, page['links'], page, fields={ 'lastmod': page.get('lastmod'), 'sitemaps': page.get('sitemaps', []) })
+            return self.iter_cached(hash, page, ignores, visited)
+
+        return self.iter_parsed(hash, link, None, res, page, ignores, visited)
+
+    def use_title_lookup(self):
+        # A sitemap can list tens of thousands of pages, and looking up each
+        # title is one more request per page.
+        return self.variables.get('sitemap_titles', 'off') == 'on'
+
+    def make_link_set(self, hash, link, depth, ignores):
+        links = self.iter_link_set(hash, link, depth, ignores)
+        if links is None:
+            return None
+        return dict(links)
+
+if __name__ == '__main__':
+    import logging
+    import pprint
+    if len(sys.argv) > 1:
+        links = {}
+        for i in range(1, len(sys.argv)):
+            links.update(Source('(name)', '(resid)', logging.getLogger()).make_link_set('(hash)', sys.argv[i], 0, None))
+        pprint.pprint(links)
@@ -4,14 +4,12 @@ import os
 import sys
 import time
 
-from slack_sdk import WebClient
-from slack_sdk.errors import SlackClientError, SlackApiError
-
 from sitewatcher.interfaces.ifprinter import BasePrinter
 
 class Printer(BasePrinter):
 
     def __init__(self, args=None, variables=None):
+        from slack_sdk import WebClient
         token = variables.get('slack_bot_token')
         if token is None:
             token = os.environ.get('SLACK_BOT_TOKEN')
@@ -20,6 +18,7 @@ class Printer(BasePrinter):
         self.variables = variables
 
     def print(self, site_name, site_link, message, text, link, hash=None):
+        from slack_sdk.errors import SlackClientError, SlackApiError
         if self.args is not None:
             channel = '#' + self.args
         else:
@@ -1,14 +1,153 @@
 #!/usr/bin/python3
 
+import hashlib
+import json
+import sys
+import threading
+
+from sitewatcher import httpclient
+
+redis_skey_pages = 'pages'
+stream_chunk_bytes = 65536
+
+class DigestReader:
+
+    def __init__(self, res):
+        res.raw.decode_content = True
+        self.raw = res.raw
+        self.digest = hashlib.blake2b(digest_size=16)
+
+    def read(self, size=-1):
+        data = self.raw.read(size if size is not None and size >= 0 else stream_chunk_bytes)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
 class BaseSource:
 
-    def __init__(self, name, resid, logger):
+    def __init__(self, name, resid, logger, variables=None, redis=None):
         self.name = name
         self.resid = resid
         self.logger = logger
+        self.variables = variables if variables is not None else {}
+        self.redis = redis
+        self.pages = {}
+        self.fingerprint = self.variables.get('fingerprint', 'on') != 'off'
+        self.pages_changed = 0
+        self.pages_unchanged = 0
+        self.pages_lock = threading.Lock()
+
+    @property
+    def session(self):
+        return httpclient.get_session()
+
+    def fetch(self, link, headers=None, stream=False):
+        res = None
+        try:
+            res = httpclient.get(link, headers=headers, stream=stream)
+        except Exception as e:
+            print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
+            self.logger.warning('{}: failed to fetch {}'.format(self.name, link))
+            self.logger.debug(e)
+            return None
+
+        if res.status_code >= 400:
+            res.close()
+            print('{}: failed to fetch {}. Status code={}'.format(self.name, link, res.status_code), file=sys.stderr)
+            self.logger.warning('{}: failed to fetch {}. Status code={}'.format(self.name, link, res.status_code))
+            return None
+
+        return res
+
+    def is_ignored(self, link, ignores):
+        return ignores is not None and ignores.matches(link)
+
+    def get_page(self, link):
+        if self.redis is None:
+            return None
+        page = self.redis.hget(self.resid + '+' + redis_skey_pages, link)
+        if page is None:
+            return None
+        return json.loads(page)
+
+    def get_page_headers(self, page):
+        headers = {}
+        if page is not None:
+            if page.get('etag') is not None:
+                headers.update({ 'If-None-Match': page['etag'] })
+            if page.get('modified') is not None:
+                headers.update({ 'If-Modified-Since': page['modified'] })
+        return headers
+
+    def get_page_links(self, page, parent):
+        return { h: dict(v, parent=parent) for h, v in page['links'].items() }
+
+    def get_digest(self, content):
+        return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+    def is_page_unchanged(self, page, res):
+        if page is None or 'links' not in page:
+            unchanged = False
+        elif res.status_code == 304:
+            unchanged = True
+        else:
+            unchanged = self.fingerprint and page.get('digest') == self.get_digest(res.content)
+        self.count_page(unchanged)
+        return unchanged
+
+    def count_page(self, unchanged):
+        with self.pages_lock:
+            if unchanged:
+                self.pages_unchanged += 1
+            else:
+                self.pages_changed += 1
+
+    def is_unchanged(self):
+        return self.pages_changed == 0 and self.pages_unchanged > 0
+
+    def set_page(self, link, res, links, page=None, digest=None, fields=None):
+        etag = res.headers.get('ETag')
+        modified = res.headers.get('Last-Modified')
+        if res.status_code == 304:
+            if page is not None:
+                etag = etag if etag is not None else page.get('etag')
+                modified = modified if modified is not None else page.get('modified')
+                digest = page.get('digest')
+        elif digest is None and self.fingerprint:
+            digest = self.get_digest(res.content)
+        if etag is not None or modified is not None or digest is not None:
+            record = { 'etag': etag, 'modified': modified, 'digest': digest, 'links': links }
+            if fields is not None:
+                record.update(fields)
+            self.pages.update({ link: json.dumps(record, ensure_ascii=False) })
+
+    def keep_page(self, link, page):
+        self.pages.update({ link: json.dumps(page, ensure_ascii=False) })
+
+    def commit(self, pipeline=None):
+        # The hash is replaced with the pages visited by this update, so that
+        # records of pages that are no longer linked do not pile up.
+        if len(self.pages) > 0 and (pipeline is not None or self.redis is not None):
+            target = pipeline if pipeline is not None else self.redis.pipeline(transaction=True)
+            target.delete(self.resid + '+' + redis_skey_pages)
+            target.hset(self.resid + '+' + redis_skey_pages, mapping=self.pages)
+            if pipeline is None:
+                target.execute()
+        self.pages = {}
 
     def make_link_set(self, hash, link, depth, ignores):
         return None
 
+    def iter_link_set(self, hash, link, depth, ignores):
+        links = self.make_link_set(hash, link, depth, ignores)
+        if links is None:
+            return None
+        return iter(links.items())
+
     def use_tag_title(self):
         return False
+
+    def use_title_lookup(self):
+        return True
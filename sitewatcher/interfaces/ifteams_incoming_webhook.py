@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 
 import os
-import requests
 import sys
 
 from sitewatcher.interfaces.ifprinter import BasePrinter
@@ -63,7 +62,7 @@ class Printer(BasePrinter):
 
             res = None
             try:
-                res = requests.post(self.webhook, json=data)
+                res = self.session.post(self.webhook, json=data)
             except Exception as e:
                 print(f'Webhook {type(e).__name__}: failed to send message ({message[0:32]})', file=sys.stderr)
                 print(e, file=sys.stderr)
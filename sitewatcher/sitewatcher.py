@@ -1,41 +1,98 @@
 #!/usr/bin/python3
 
-import difflib
-import filetype
+import time
+imports_started = time.perf_counter()
+
 import hashlib
 import io
+import itertools
 import json
 import logging
 import os
 import re
-import requests
+import socket
 import sys
-import time
-from bs4 import BeautifulSoup
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from importlib import import_module
 from redis import Redis
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
+
+from sitewatcher.ignores import compile_ignores, get_rule_error
+
+imports_seconds = time.perf_counter() - imports_started
 
 logger = None
 debug_mode = False
 
 redis = None
 
+interface_modules = {}
+interface_lock = threading.Lock()
+
+title_concurrency_default = 4
+title_max_bytes_default = 524288
+title_sniff_bytes = 8192
+title_chunk_bytes = 8192
+title_head_end = re.compile(rb'</head\s*>', re.IGNORECASE)
+title_html_types = ['text/html', 'application/xhtml+xml']
+title_cache_enabled = True
+title_cache_ttl_default = 604800
+title_cache_negative_ttl_default = 3600
+title_cache_size_default = 100000
+title_cache_lock = threading.Lock()
+
+hash_changing_variables = {
+    'html_parser': 'link tags depend on the parser, so links of html sites may be reported as added and removed once'
+}
+
+schedule_min_interval_default = 3600
+schedule_max_interval_default = 86400
+schedule_backoff_default = 1.5
+schedule_speedup_default = 0.5
+schedule_slack = 300
+
+serve_update_interval_default = 3600
+serve_print_interval_default = 3600
+
+queue_visibility_default = 600
+queue_poll_interval = 1
+queue_max_attempts = 3
+queue_retry_delay = 60
+queue_worker_ttl = 86400
+
 json_section_data = 'data'
 json_section_config = 'config'
 json_section_header = 'header'
 json_section_updated = 'updated'
 json_section_links = 'links'
+json_section_type = 'type'
+json_section_site = 'site'
+json_section_key = 'key'
+json_section_hash = 'hash'
+json_section_link = 'link'
+
+ndjson_batch_size = 500
+redis_batch_size = 500
 
 redis_skey_index = 'index'
+redis_skey_registry = 'registry'
 redis_skey_ignores = 'ignores'
 redis_skey_hashes = 'hashes'
 redis_skey_latests = 'latests'
 redis_skey_variables = 'variables'
+redis_skey_pages = 'pages'
+redis_skey_titles = 'titles'
+redis_zkey_queue = 'queue'
+redis_hkey_jobs = 'jobs'
+redis_skey_workers = 'workers'
+redis_skey_worker = 'worker'
 
 redis_lkey_updated = 'updated'
 redis_lmax_updated = 10
+redis_lkey_changes = 'changes'
+redis_lmax_changes = 10
 
 redis_strkey_resid = 'resid'
 
@@ -46,6 +103,9 @@ redis_hkey_link = 'link'
 redis_hkey_parent = 'parent'
 redis_hkey_tag = 'tag'
 redis_hkey_site = 'site'
+redis_hkey_interval = 'interval'
+redis_hkey_due = 'due'
+redis_hkey_printed = 'printed'
 
 def is_redis_empty():
     return redis.dbsize() == 0
@@ -55,10 +115,12 @@ def add_redis_name(name, resid):
     redis.set(name_lower, resid)
     redis.hset(resid, redis_hkey_name, name)
     redis.sadd(redis_skey_index, name_lower)
+    redis.hset(redis_skey_registry, name_lower, resid)
 
 def delete_redis_name(name, resid):
     name_lower = name.lower()
     redis.srem(redis_skey_index, name_lower)
+    redis.hdel(redis_skey_registry, name_lower)
     redis.delete(name_lower)
     redis.delete(resid)
 
@@ -69,10 +131,38 @@ def rename_redis_name(old_name, new_name, resid):
     redis.hset(resid, redis_hkey_name, new_name)
     redis.sadd(redis_skey_index, new_name_lower)
     redis.srem(redis_skey_index, old_name_lower)
+    redis.hdel(redis_skey_registry, old_name_lower)
+    redis.hset(redis_skey_registry, new_name_lower, resid)
 
 def get_redis_names():
     return redis.smembers(redis_skey_index)
 
+def get_redis_registry():
+    # The registry maps every indexed name to its resid in one hash. It is
+    # rebuilt from the index when they disagree, e.g. after an upgrade.
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.hgetall(redis_skey_registry)
+    pipeline.scard(redis_skey_index)
+    registry, count = pipeline.execute()
+    if len(registry) != count:
+        names = list(get_redis_names())
+        for n in names:
+            pipeline.get(n)
+        registry = { n: resid for n, resid in zip(names, pipeline.execute()) if resid is not None }
+        pipeline.delete(redis_skey_registry)
+        if len(registry) > 0:
+            pipeline.hset(redis_skey_registry, mapping=registry)
+        pipeline.execute()
+    return registry
+
+def get_redis_sites(registry, names):
+    pipeline = redis.pipeline(transaction=False)
+    for n in names:
+        pipeline.hgetall(registry[n])
+        pipeline.hgetall(registry[n] + '+' + redis_skey_variables)
+    values = pipeline.execute()
+    return [(registry[n], values[i * 2], values[i * 2 + 1]) for i, n in enumerate(names)]
+
 def get_redis_resid(name):
     name_lower = name.lower()
     return redis.get(name_lower)
@@ -169,6 +259,111 @@ def delete_redis_global_variable(var):
 def delete_redis_global_variables():
     redis.delete(redis_skey_variables)
 
+def get_interface(interface):
+    if re.fullmatch('[a-z0-9_]+', interface) is None:
+        return None
+    with interface_lock:
+        module = interface_modules.get(interface)
+        if module is None:
+            name = f'{__package__}.interfaces.if{interface}'
+            try:
+                module = import_module(name)
+            except ModuleNotFoundError as e:
+                # A missing dependency of an existing interface is an error,
+                # not an unknown interface.
+                if e.name != name:
+                    raise
+                return None
+            interface_modules[interface] = module
+        return module
+
+def get_redis_title_key(link):
+    return redis_skey_titles + '+' + hashlib.md5(link.encode()).hexdigest()
+
+def get_redis_title(link):
+    key = get_redis_title_key(link)
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.get(key)
+    pipeline.zadd(redis_skey_titles, { key: time.time() })
+    return pipeline.execute()[0]
+
+def set_redis_title(link, info, ttl):
+    key = get_redis_title_key(link)
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.set(key, info, ex=ttl)
+    pipeline.zadd(redis_skey_titles, { key: time.time() })
+    pipeline.execute()
+
+def evict_redis_titles(size):
+    excess = redis.zcard(redis_skey_titles) - size
+    if excess > 0:
+        keys = redis.zrange(redis_skey_titles, 0, excess - 1)
+        if len(keys) > 0:
+            redis.delete(*keys)
+            redis.zrem(redis_skey_titles, *keys)
+    return max(excess, 0)
+
+def get_redis_queue_key(skey=None):
+    return redis_zkey_queue if skey is None else redis_zkey_queue + '+' + skey
+
+def enqueue_redis_job(method, name, resid, now):
+    # A site has at most one pending job per method; the score of a job is
+    # the time it becomes visible to workers.
+    job_id = method + '+' + resid
+    job = json.dumps({ 'id': job_id, 'method': method, 'name': name, 'now': now, 'attempts': 0 }, ensure_ascii=False)
+    pipeline = redis.pipeline()
+    pipeline.hsetnx(get_redis_queue_key(redis_hkey_jobs), job_id, job)
+    pipeline.zadd(get_redis_queue_key(), { job_id: time.time() }, nx=True)
+    return pipeline.execute()[1] == 1
+
+def claim_redis_job(visibility):
+    from redis.exceptions import WatchError
+    with redis.pipeline() as pipeline:
+        while True:
+            try:
+                pipeline.watch(get_redis_queue_key())
+                now = time.time()
+                job_ids = pipeline.zrangebyscore(get_redis_queue_key(), '-inf', now, start=0, num=1)
+                if len(job_ids) == 0:
+                    pipeline.unwatch()
+                    return None
+                job = pipeline.hget(get_redis_queue_key(redis_hkey_jobs), job_ids[0])
+                pipeline.multi()
+                if job is None:
+                    pipeline.zrem(get_redis_queue_key(), job_ids[0])
+                    pipeline.execute()
+                    continue
+                job = json.loads(job)
+                job['attempts'] += 1
+                pipeline.zadd(get_redis_queue_key(), { job_ids[0]: now + visibility }, xx=True)
+                pipeline.hset(get_redis_queue_key(redis_hkey_jobs), job_ids[0], json.dumps(job, ensure_ascii=False))
+                pipeline.execute()
+                return job
+            except WatchError:
+                continue
+
+def complete_redis_job(job):
+    pipeline = redis.pipeline()
+    pipeline.zrem(get_redis_queue_key(), job['id'])
+    pipeline.hdel(get_redis_queue_key(redis_hkey_jobs), job['id'])
+    pipeline.execute()
+
+def release_redis_job(job):
+    # Retries back off exponentially, so that a site that keeps failing is
+    # not given up within seconds.
+    delay = queue_retry_delay * 2 ** max(job['attempts'] - 1, 0)
+    redis.zadd(get_redis_queue_key(), { job['id']: time.time() + delay }, xx=True)
+
+def count_redis_worker_job(worker_id, succeeded):
+    key = get_redis_queue_key(redis_skey_worker + '+' + worker_id)
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.sadd(get_redis_queue_key(redis_skey_workers), worker_id)
+    pipeline.hsetnx(key, 'started', time.time())
+    pipeline.hset(key, 'seen', time.time())
+    pipeline.hincrby(key, 'done' if succeeded else 'failed', 1)
+    pipeline.expire(key, queue_worker_ttl)
+    pipeline.execute()
+
 def dump_redis_data():
     index = redis.smembers(redis_skey_index)
     if index is None:
@@ -247,72 +442,297 @@ def dump_redis_data():
 
     return json
 
-def load_redis_data(json):
-    global_config = json[json_section_config]
-    global_data = json[json_section_data]
-
-    ignores = global_config[redis_skey_ignores]
-    for i in ignores:
-        redis.sadd(redis_skey_ignores, i)
-    variables = global_config[redis_skey_variables]
-    for k, v in variables.items():
-        redis.hset(redis_skey_variables, k, v)
-
-    for site in global_data:
-        header = global_data[site][json_section_header]
-        resid = header[redis_strkey_resid]
-
-        name = header[redis_hkey_name]
-
-        redis.set(site, resid)
-        redis.hset(resid, redis_hkey_name, header[redis_hkey_name])
-        redis.sadd(redis_skey_index, site)
-        redis.hset(resid, redis_hkey_link, header[redis_hkey_link])
-        redis.hset(resid, redis_hkey_depth, header[redis_hkey_depth])
-        if header[redis_hkey_filetype] != 'None':
-            redis.hset(resid, redis_hkey_filetype, header[redis_hkey_filetype])
-
-        config = global_data[site][json_section_config]
-        ignores = config[redis_skey_ignores]
-        for i in ignores:
-            redis.sadd(resid + '+' + redis_skey_ignores, i)
-        variables = config[redis_skey_variables]
-        for k, v in variables.items():
-            redis.hset(resid + '+' + redis_skey_variables, k, v)
-
-        updated = global_data[site][json_section_updated]
-        for sequence in updated:
-            dt = list(sequence)[0]
-            redis.rpush(resid + '+' + redis_lkey_updated, dt)
-            for uh in sequence[dt]:
-                redis.sadd(resid + '+' + dt, uh)
+def iter_redis_links(hashes, references=None):
+    # Link hashes are read in pipelined chunks. When a references dict is
+    # given, the links of parents and sites are resolved into it as well,
+    # and it can be shared between calls to avoid reading them again.
+    pipeline = redis.pipeline(transaction=False)
+    for i in range(0, len(hashes), redis_batch_size):
+        chunk = hashes[i:i + redis_batch_size]
+        for h in chunk:
+            pipeline.hgetall(h)
+        records = pipeline.execute()
+
+        if references is not None:
+            for h, record in zip(chunk, records):
+                references[h] = record.get(redis_hkey_link)
+            missing = set()
+            for record in records:
+                for ref in (record.get(redis_hkey_parent), record.get(redis_hkey_site)):
+                    if ref is not None and ref not in references:
+                        missing.add(ref)
+            missing = list(missing)
+            for ref in missing:
+                pipeline.hget(ref, redis_hkey_link)
+            references.update(zip(missing, pipeline.execute()))
+
+        yield from zip(chunk, records)
+
+def iter_redis_hashes(key):
+    batch = []
+    for h in redis.sscan_iter(key, count=ndjson_batch_size):
+        batch.append(h)
+        if len(batch) >= ndjson_batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+def iter_redis_data():
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.smembers(redis_skey_ignores)
+    pipeline.hgetall(redis_skey_variables)
+    ignores, variables = pipeline.execute()
+    yield {
+        json_section_type: json_section_config,
+        redis_skey_ignores: list(ignores),
+        redis_skey_variables: variables
+    }
 
-        links = global_data[site][json_section_links]
-        for h in links:
-            redis.sadd(resid + '+' + redis_skey_hashes, h)
-            redis.hset(h, redis_hkey_name, links[h][redis_hkey_name])
-            redis.hset(h, redis_hkey_link, links[h][redis_hkey_link])
-            if links[h][redis_hkey_parent] is not None:
-                redis.hset(h, redis_hkey_parent, links[h][redis_hkey_parent])
-            redis.hset(h, redis_hkey_site, links[h][redis_hkey_site])
-            redis.hset(h, redis_hkey_tag, links[h][redis_hkey_tag])
+    for n in redis.sscan_iter(redis_skey_index):
+        resid = redis.get(n)
+        if resid is None:
+            continue
+        pipeline.hgetall(resid)
+        pipeline.smembers(resid + '+' + redis_skey_ignores)
+        pipeline.hgetall(resid + '+' + redis_skey_variables)
+        pipeline.lrange(resid + '+' + redis_lkey_updated, 0, -1)
+        header, ignores, variables, updated_date_list = pipeline.execute()
 
+        updated = []
+        for dt in updated_date_list:
+            hashes = []
+            for batch in iter_redis_hashes(resid + '+' + dt):
+                hashes.extend(batch)
+            updated.append({ dt: hashes })
+
+        yield {
+            json_section_type: json_section_site,
+            json_section_key: n,
+            json_section_header: {
+                redis_strkey_resid: resid,
+                redis_hkey_name: header.get(redis_hkey_name),
+                redis_hkey_link: header.get(redis_hkey_link),
+                redis_hkey_depth: header.get(redis_hkey_depth),
+                redis_hkey_filetype: header.get(redis_hkey_filetype, 'None')
+            },
+            json_section_config: {
+                redis_skey_ignores: list(ignores),
+                redis_skey_variables: variables
+            },
+            json_section_updated: updated
+        }
+
+        count = 0
+        for batch in iter_redis_hashes(resid + '+' + redis_skey_hashes):
+            for h in batch:
+                pipeline.hgetall(h)
+            for h, values in zip(batch, pipeline.execute()):
+                yield {
+                    json_section_type: json_section_link,
+                    json_section_key: n,
+                    json_section_hash: h,
+                    json_section_link: {
+                        redis_hkey_name: values.get(redis_hkey_name),
+                        redis_hkey_link: values.get(redis_hkey_link),
+                        redis_hkey_parent: values.get(redis_hkey_parent),
+                        redis_hkey_site: values.get(redis_hkey_site),
+                        redis_hkey_tag: values.get(redis_hkey_tag)
+                    }
+                }
+            count += len(batch)
 
-        print('{}: {} links and {} sequences loaded'.format(name, len(links), len(updated)), file=sys.stderr)
+        print('{}: {} links and {} sequences dumped'.format(header.get(redis_hkey_name), count, len(updated_date_list)), file=sys.stderr)
 
-    return len(global_data)
+def iter_site_records(key, site):
+    yield {
+        json_section_type: json_section_site,
+        json_section_key: key,
+        json_section_header: site[json_section_header],
+        json_section_config: site[json_section_config],
+        json_section_updated: site[json_section_updated]
+    }
+    for h, values in site[json_section_links].items():
+        yield {
+            json_section_type: json_section_link,
+            json_section_key: key,
+            json_section_hash: h,
+            json_section_link: values
+        }
+
+def iter_document_records(stream):
+    # Builds one top-level section or one site at a time, so that a JSON
+    # export is converted to records without holding the whole document.
+    import ijson
+    from ijson.common import ObjectBuilder
+
+    builder = None
+    depth = 0
+    key = None
+    for prefix, event, value in ijson.parse(stream):
+        if builder is None:
+            if prefix == json_section_data and event == 'map_key':
+                key = value
+                continue
+            if event == 'start_map' and (prefix == json_section_config or (key is not None and prefix == json_section_data + '.' + key)):
+                builder = ObjectBuilder()
+                depth = 0
+            else:
+                continue
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                if prefix == json_section_config:
+                    yield dict(builder.value, **{ json_section_type: json_section_config })
+                else:
+                    yield from iter_site_records(key, builder.value)
+                builder = None
+
+def iter_ndjson_records(stream):
+    for line in stream:
+        line = line.strip()
+        if len(line) > 0:
+            yield json.loads(line)
+
+def load_redis_records(records, batch_size=1000, merge=False):
+    started = time.time()
+    pipeline = redis.pipeline(transaction=False)
+    queued = 0
+    count = 0
+    resids = {}
+    site_counts = {}
+
+    for record in records:
+        record_type = record.get(json_section_type)
+        if record_type == json_section_config:
+            if len(record[redis_skey_ignores]) > 0:
+                pipeline.sadd(redis_skey_ignores, *record[redis_skey_ignores])
+            if len(record[redis_skey_variables]) > 0:
+                pipeline.hset(redis_skey_variables, mapping=record[redis_skey_variables])
+        elif record_type == json_section_site:
+            site = record[json_section_key]
+            header = record[json_section_header]
+            resid = header[redis_strkey_resid]
+            resids[site] = resid
+            site_counts[site] = [header[redis_hkey_name], 0, len(record[json_section_updated])]
+
+            values = {
+                redis_hkey_name: header[redis_hkey_name],
+                redis_hkey_link: header[redis_hkey_link],
+                redis_hkey_depth: header[redis_hkey_depth]
+            }
+            if header[redis_hkey_filetype] != 'None':
+                values.update({ redis_hkey_filetype: header[redis_hkey_filetype] })
+
+            # A merged site replaces the existing one of the same name. One
+            # stored under another resid is deleted as a whole, and one under
+            # the same resid loses its sequences, which come from the import.
+            if merge:
+                old_resid = redis.get(site)
+                if old_resid is not None and old_resid != resid:
+                    print('{}: replacing the existing site {}'.format(site, old_resid), file=sys.stderr)
+                    Site(site).delete()
+                elif old_resid is not None:
+                    for dt in get_redis_list_values(resid, redis_lkey_updated):
+                        pipeline.delete(resid + '+' + dt)
+                    pipeline.delete(resid + '+' + redis_lkey_updated)
+            pipeline.set(site, resid)
+            pipeline.hset(resid, mapping=values)
+            pipeline.sadd(redis_skey_index, site)
+            pipeline.hset(redis_skey_registry, site, resid)
+
+            config = record[json_section_config]
+            if len(config[redis_skey_ignores]) > 0:
+                pipeline.sadd(resid + '+' + redis_skey_ignores, *config[redis_skey_ignores])
+            if len(config[redis_skey_variables]) > 0:
+                pipeline.hset(resid + '+' + redis_skey_variables, mapping=config[redis_skey_variables])
+
+            for sequence in record[json_section_updated]:
+                dt = list(sequence)[0]
+                pipeline.rpush(resid + '+' + redis_lkey_updated, dt)
+                if len(sequence[dt]) > 0:
+                    pipeline.sadd(resid + '+' + dt, *sequence[dt])
+        elif record_type == json_section_link:
+            site = record[json_section_key]
+            resid = resids.get(site)
+            if resid is None:
+                print('{}: link {} without a site record'.format(site, record[json_section_hash]), file=sys.stderr)
+                continue
+            h = record[json_section_hash]
+            link = record[json_section_link]
+            values = {
+                redis_hkey_name: link[redis_hkey_name],
+                redis_hkey_link: link[redis_hkey_link],
+                redis_hkey_site: link[redis_hkey_site],
+                redis_hkey_tag: link[redis_hkey_tag]
+            }
+            if link[redis_hkey_parent] is not None:
+                values.update({ redis_hkey_parent: link[redis_hkey_parent] })
+            pipeline.sadd(resid + '+' + redis_skey_hashes, h)
+            pipeline.hset(h, mapping=values)
+            site_counts[site][1] += 1
+        else:
+            continue
+
+        count += 1
+        queued += 1
+        if queued >= batch_size:
+            pipeline.execute()
+            queued = 0
+            elapsed = time.time() - started
+            print('{} records imported, {:.0f} records/s'.format(count, count / elapsed if elapsed > 0 else 0), file=sys.stderr)
+
+    pipeline.execute()
+    for name, links, sequences in site_counts.values():
+        print('{}: {} links and {} sequences loaded'.format(name, links, sequences), file=sys.stderr)
+    elapsed = time.time() - started
+    print('{} records imported in {:.3f}s, {:.0f} records/s'.format(count, elapsed, count / elapsed if elapsed > 0 else 0), file=sys.stderr)
+
+    return len(site_counts)
+
+def load_redis_data(json, batch_size=1000, merge=False):
+    def iter_records():
+        yield dict(json[json_section_config], **{ json_section_type: json_section_config })
+        for site in json[json_section_data]:
+            yield from iter_site_records(site, json[json_section_data][site])
+    return load_redis_records(iter_records(), batch_size, merge)
+
+class ChainedReader:
+
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+
+    def read(self, size=-1):
+        if len(self.head) > 0 and size != 0:
+            data, self.head = self.head, b''
+            return data
+        return self.stream.read(size)
 
 class Site:
 
-    def __init__(self, name):
+    def __init__(self, name, resid=None, values=None, variables=None):
         self.name = name
-        self.resid = get_redis_resid(self.name)
-        if self.resid is None:
-            self.resid = hashlib.md5(self.name.encode()).hexdigest()
-            self.exists = False
-        else:
-            self.name = get_redis_value(self.resid, redis_hkey_name)
+        self.values = values
+        self.variables = variables
+        if resid is not None and values is not None:
+            self.resid = resid
+            self.name = values.get(redis_hkey_name, name)
             self.exists = True
+        else:
+            self.resid = get_redis_resid(self.name)
+            if self.resid is None:
+                self.resid = hashlib.md5(self.name.encode()).hexdigest()
+                self.exists = False
+            else:
+                self.name = get_redis_value(self.resid, redis_hkey_name)
+                self.exists = True
+        self.pages_unchanged = 0
+        self.title_cache_hits = 0
+        self.title_cache_misses = 0
 
     def add(self, link, filetype, depth):
         if self.exists == True:
@@ -344,12 +764,14 @@ class Site:
         for updated in get_redis_list_values(self.resid, redis_lkey_updated):
             delete_redis_set(self.resid, updated)
         delete_redis_list(self.resid, redis_lkey_updated)
+        delete_redis_list(self.resid, redis_lkey_changes)
 
         hashes = get_redis_smembers(self.resid, redis_skey_hashes)
         for h in hashes:
             delete_redis_values(h)
         delete_redis_set(self.resid, redis_skey_hashes)
         delete_redis_set(self.resid, redis_skey_ignores)
+        delete_redis_set(self.resid, redis_skey_pages)
 
         delete_redis_name(self.name, self.resid)
         self.exists = False
@@ -381,10 +803,16 @@ class Site:
             set_redis_value(self.resid, redis_hkey_depth, depthv[0])
         if ignoresv is not None:
             for i in ignoresv:
+                error = get_rule_error(i)
+                if error is not None:
+                    print('{}: cannot ignore {}: {}'.format(self.name, i, error), file=sys.stderr)
+                    continue
                 add_redis_smember(self.resid, redis_skey_ignores, i)
         if recognizev is not None:
             for r in recognizev:
                 remove_redis_smember(self.resid, redis_skey_ignores, r)
+        if any(v is not None for v in [linkv, filetypev, depthv, ignoresv, recognizev]):
+            delete_redis_set(self.resid, redis_skey_pages)
 
         link = get_redis_value(self.resid, redis_hkey_link)
         filetype = get_redis_value(self.resid, redis_hkey_filetype)
@@ -410,11 +838,16 @@ class Site:
             set_redis_variable(self.resid, var, val)
         else:
             delete_redis_variable(self.resid, var)
+        # Variables can change how links are extracted, and a cached page
+        # that has not changed would otherwise keep its old link set.
+        delete_redis_set(self.resid, redis_skey_pages)
 
         if debug_mode is True:
             print('{} {} {} {}'.format(self.resid, self.name, var, val))
         else:
             print('{} {} {}'.format(self.name, var, val))
+        if var in hash_changing_variables:
+            print('{}: {}: {}'.format(self.name, var, hash_changing_variables[var]), file=sys.stderr)
 
         return True
 
@@ -423,7 +856,7 @@ class Site:
             print('{}: no such a site'.format(self.name), file=sys.stderr)
             return False
 
-        variables = get_redis_variables(self.resid)
+        variables = self.variables if self.variables is not None else get_redis_variables(self.resid)
         for k, v in variables.items():
             if debug_mode is True:
                 print('{} {} {} {}'.format(self.resid, self.name, k, v))
@@ -432,62 +865,157 @@ class Site:
 
         return True
 
-    def get_title(self, name, link, parent_name):
-        title = name
-        res = None
-        headers = { 'Cache-Control': 'no-cache', 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Safari/537.36' }
+    def get_title_type(self, link):
+        import filetype
+        from sitewatcher import httpclient
         try:
-            res = requests.get(link, headers=headers, timeout=10)
-        except requests.exceptions.InvalidSchema as e:
-            print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
-            logger.warning('{}: failed to fetch {}'.format(self.name, link))
+            res = httpclient.head(link)
+        except Exception as e:
             logger.debug(e)
-            return title
-        except requests.exceptions.RequestException as e:
+            return None
+        if res.status_code >= 400:
+            return None
+        content_type = res.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if len(content_type) == 0 or content_type in title_html_types:
+            return None
+        return filetype.get_type(mime=content_type)
+
+    def read_title_content(self, res, max_bytes):
+        import filetype
+        content = bytearray()
+        sniffed = False
+        try:
+            for chunk in res.iter_content(chunk_size=title_chunk_bytes):
+                searched = max(0, len(content) - 8)
+                content.extend(chunk)
+                if not sniffed and len(content) >= title_sniff_bytes:
+                    sniffed = True
+                    if filetype.guess(content[:title_sniff_bytes]) is not None:
+                        break
+                if title_head_end.search(content, searched) is not None or len(content) >= max_bytes:
+                    break
+        finally:
+            res.close()
+        return bytes(content[:max_bytes])
+
+    def fetch_title_info(self, link, variables):
+        import filetype
+        from bs4 import BeautifulSoup
+        from sitewatcher import httpclient
+        if variables.get('title_head') == 'on':
+            ftype = self.get_title_type(link)
+            if ftype is not None:
+                return { 'extension': ftype.extension }
+
+        res = None
+        try:
+            res = httpclient.get(link, stream=True)
+        except Exception as e:
             print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
             logger.warning('{}: failed to fetch {}'.format(self.name, link))
             logger.debug(e)
-            return title
+            return { 'failed': True }
+
+        if res.status_code >= 400:
+            res.close()
+            logger.warning('{}: failed to fetch {}. Status code={}'.format(self.name, link, res.status_code))
+            return { 'failed': True }
+
+        try:
+            content = self.read_title_content(res, int(variables.get('title_max_bytes', title_max_bytes_default)))
         except Exception as e:
             print('{}: failed to fetch {}'.format(self.name, link), file=sys.stderr)
             logger.warning('{}: failed to fetch {}'.format(self.name, link))
             logger.debug(e)
-            return title
-
-        if res is not None:
-            if res.status_code >= 400:
-                logger.warning('{}: failed to fetch {}. Status code={}'.format(self.name, link, res.status_code))
+            return { 'failed': True }
+
+        ftype = filetype.guess(content)
+        if ftype:
+            return { 'extension': ftype.extension }
+
+        real_title = None
+        enc = res.encoding if res.encoding != 'ISO-8859-1' else None
+        bs = BeautifulSoup(content, 'html.parser', from_encoding=enc)
+        bs_tag = bs.find('title')
+        bs_ogp = bs.find('meta', attrs={'property': 'og:title'})
+        if bs_ogp is not None:
+            real_title = bs_ogp.get('content')
+        elif bs_tag is not None:
+            real_title = bs_tag.get_text()
+        return { 'title': real_title }
+
+    def get_title_info(self, link, variables):
+        if title_cache_enabled is False:
+            return self.fetch_title_info(link, variables)
+
+        info = get_redis_title(link)
+        with title_cache_lock:
+            if info is not None:
+                self.title_cache_hits += 1
             else:
-                ftype = filetype.guess(res.content)
-                if ftype:
-                    if parent_name is None:
-                        parent_name = ''
-                    title = '[' + ftype.extension + ']' + parent_name + '::' + title
+                self.title_cache_misses += 1
+        if info is not None:
+            return json.loads(info)
+
+        info = self.fetch_title_info(link, variables)
+        if info.get('failed') is True:
+            ttl = int(variables.get('title_cache_negative_ttl', title_cache_negative_ttl_default))
+        else:
+            ttl = int(variables.get('title_cache_ttl', title_cache_ttl_default))
+        set_redis_title(link, json.dumps(info, ensure_ascii=False), ttl)
+        return info
+
+    def get_title(self, name, link, parent_name, variables=None):
+        if variables is None:
+            variables = {}
+        title = name
+
+        info = self.get_title_info(link, variables)
+        if info.get('extension') is not None:
+            if parent_name is None:
+                parent_name = ''
+            title = '[' + info['extension'] + ']' + parent_name + '::' + title
+        elif info.get('title') is not None:
+            real_title = info['title'].strip()
+            lt = len(title)
+            lrt = len(real_title)
+            if lrt > 0:
+                if lt >= lrt and title.find(real_title) >= 0:
+                    pass
+                elif lt <= lrt and real_title.find(title) >= 0:
+                    title = real_title
                 else:
-                    real_title = None
-                    enc = res.encoding if res.encoding != 'ISO-8859-1' else None
-                    bs = BeautifulSoup(res.content, 'html.parser', from_encoding=enc)
-                    bs_tag = bs.find('title')
-                    bs_ogp = bs.find('meta', attrs={'property': 'og:title'})
-                    if bs_ogp is not None:
-                        real_title = bs_ogp.get('content')
-                    elif bs_tag is not None:
-                        real_title = bs_tag.get_text()
-                    if real_title is not None:
-                        real_title = real_title.strip()
-                        lt = len(title)
-                        lrt = len(real_title)
-                        if lrt > 0:
-                            if lt >= lrt and title.find(real_title) >= 0:
-                                pass
-                            elif lt <= lrt and real_title.find(title) >= 0:
-                                title = real_title
-                            else:
-                                title = title + '::' + real_title.strip()
+                    title = title + '::' + real_title.strip()
 
         return title
 
-    def update(self, now=None):
+    def get_titles(self, title_requests, variables):
+        width = int(variables.get('title_concurrency', title_concurrency_default))
+        if width <= 1 or len(title_requests) <= 1:
+            return [self.get_title(n, l, p, variables) for n, l, p in title_requests]
+
+        def get_title_at(index):
+            name, link, parent_name = title_requests[index]
+            return index, self.get_title(name, link, parent_name, variables)
+
+        # Interleave hosts so that workers are not all parked on the
+        # httpclient slots of one busy host.
+        by_host = {}
+        for i, r in enumerate(title_requests):
+            by_host.setdefault(urlparse(r[1]).netloc.lower(), []).append(i)
+        order = []
+        queues = list(by_host.values())
+        while len(queues) > 0:
+            order.extend(q.pop(0) for q in queues)
+            queues = [q for q in queues if len(q) > 0]
+
+        titles = [None] * len(title_requests)
+        with ThreadPoolExecutor(max_workers=width) as executor:
+            for i, title in executor.map(get_title_at, order):
+                titles[i] = title
+        return titles
+
+    def update(self, now=None, global_ignores=None):
         if self.exists == False:
             print('{}: no such a site'.format(self.name), file=sys.stderr)
             return False
@@ -495,47 +1023,76 @@ class Site:
         if now is None:
             now = time.time()
 
-        link = get_redis_value(self.resid, redis_hkey_link)
-        filetype = get_redis_value(self.resid, redis_hkey_filetype)
-        depth = int(get_redis_value(self.resid, redis_hkey_depth))
-        old_hashes = list(get_redis_smembers(self.resid, redis_skey_hashes))
+        pipeline = redis.pipeline(transaction=False)
+        pipeline.hmget(self.resid, redis_hkey_link, redis_hkey_filetype, redis_hkey_depth)
+        pipeline.smembers(self.resid + '+' + redis_skey_hashes)
+        pipeline.smembers(self.resid + '+' + redis_skey_ignores)
+        pipeline.hgetall(redis_skey_variables)
+        pipeline.hgetall(self.resid + '+' + redis_skey_variables)
+        pipeline.lrange(self.resid + '+' + redis_lkey_updated, 0, -1)
+        (link, filetype, depth), old_hashes, site_ignores, variables, site_variables, updated = pipeline.execute()
+
+        depth = int(depth)
+        old_hashes = list(old_hashes)
         if len(old_hashes) == 0:
             logger.info('{}: first update'.format(self.name))
-        ignores = get_redis_smembers(self.resid, redis_skey_ignores)
-        ignores_all = get_redis_ignores()
-        if ignores_all is not None:
-            if ignores is None:
-                ignores = ignores_all
-            else:
-                ignores.update(ignores_all)
+        if global_ignores is None:
+            global_ignores = compile_ignores(get_redis_ignores())
+        ignores = compile_ignores(site_ignores, global_ignores)
+        variables.update(site_variables)
 
         interface = filetype if filetype is not None else 'html' 
-        module = import_module('.if' + interface, f'{__package__}.interfaces')
-        source = module.Source(self.name, self.resid, logger)
+        module = get_interface(interface)
+        if module is None or not hasattr(module, 'Source'):
+            print('{}: {} is not a source interface'.format(self.name, interface), file=sys.stderr)
+            return False
+        source = module.Source(self.name, self.resid, logger, variables, redis)
         if debug_mode:
             print('{} {} {}'.format(self.name, self.resid, interface), file=sys.stderr)
-        links = source.make_link_set(self.resid, link, depth, ignores)
+        link_set = source.iter_link_set(self.resid, link, depth, ignores)
 
-        if links is None or len(links) == 0:
+        # Sources that do not look up titles never need other records, so
+        # only the new ones are kept while the link set is consumed.
+        old_hash_set = set(old_hashes)
+        keep_all = not source.use_tag_title() and source.use_title_lookup()
+        links = {}
+        hashes = set()
+        if link_set is not None:
+            for h, v in link_set:
+                hashes.add(h)
+                if keep_all or h not in old_hash_set:
+                    links[h] = v
+        self.pages_unchanged = source.pages_unchanged
+
+        # Every write of the update goes into one MULTI/EXEC block, so that a
+        # crash never leaves half-written link hashes behind.
+        pipeline = redis.pipeline(transaction=True)
+        changed = False
+        if source.is_unchanged():
+            logger.info('{}: unchanged: {} pages'.format(self.name, source.pages_unchanged))
+        elif len(hashes) == 0:
             logger.warning('{}: no links found'.format(self.name))
         else:
-            hashes = links.keys()
-
-            latests = list(set(hashes) - set(old_hashes))
-            obsoletes = list(set(old_hashes) - set(hashes))
+            latests = [h for h in links if h not in old_hash_set]
+            obsoletes = list(old_hash_set - hashes)
 
             logger.debug('{}: old: {}'.format(self.name, old_hashes))
             logger.debug('{}: new: {}'.format(self.name, hashes))
             logger.debug('{}: latests: {}'.format(self.name, latests))
             logger.debug('{}: obsoletes: {}'.format(self.name, obsoletes))
 
+            changed = len(old_hashes) > 0 and (len(latests) > 0 or len(obsoletes) > 0)
+
             if len(latests) > 0:
                 if source.use_tag_title():
                     logger.debug('Using tags as titles')
-                for h in latests:
-                    if source.use_tag_title():
-                        title = links[h]['tag']
-                    else:
+                    titles = [links[h]['tag'] for h in latests]
+                elif not source.use_title_lookup():
+                    logger.debug('Skipping title lookups')
+                    titles = [''] * len(latests)
+                else:
+                    title_requests = []
+                    for h in latests:
                         parent_name = None
                         parent = links[h]['parent']
                         if parent is not None:
@@ -543,45 +1100,120 @@ class Site:
                                 parent_name = self.name
                             else:
                                 parent_name = links[parent]['name']
-                        title = self.get_title(links[h]['name'], links[h]['link'], parent_name)
+                        title_requests.append((links[h]['name'], links[h]['link'], parent_name))
+                    titles = self.get_titles(title_requests, variables)
+                    if title_cache_enabled:
+                        logger.info('{}: title cache: {} hits, {} misses'.format(self.name, self.title_cache_hits, self.title_cache_misses))
+                        evict_redis_titles(int(variables.get('title_cache_size', title_cache_size_default)))
+                for h, title in zip(latests, titles):
                     if len(title) > 0:
                         links[h]['name'] = title
                         links[h]['tag'] = title + ' ---- ' + links[h]['link']
-                    add_redis_smember(self.resid, redis_skey_hashes, h)
-                    set_redis_value(h, redis_hkey_site, links[h]['site'])
-                    set_redis_value(h, redis_hkey_name, links[h]['name'])
-                    set_redis_value(h, redis_hkey_link, links[h]['link'])
+                    values = {
+                        redis_hkey_site: links[h]['site'],
+                        redis_hkey_name: links[h]['name'],
+                        redis_hkey_link: links[h]['link'],
+                        redis_hkey_tag: links[h]['tag']
+                    }
                     if links[h]['parent'] is not None:
-                        set_redis_value(h, redis_hkey_parent, links[h]['parent'])
-                    set_redis_value(h, redis_hkey_tag, links[h]['tag'])
+                        values.update({ redis_hkey_parent: links[h]['parent'] })
+                    pipeline.hset(h, mapping=values)
                     logger.info('{}: added: {} {}'.format(self.name, h, links[h]['tag']))
+                pipeline.sadd(self.resid + '+' + redis_skey_hashes, *latests)
 
                 if len(old_hashes) > 0:
-                    for h in latests:
-                        add_redis_smember(self.resid, str(now), h)
+                    pipeline.sadd(self.resid + '+' + str(now), *latests)
 
                 print('{}: updated'.format(self.name), file=sys.stderr)
 
-            for h in obsoletes:
-                remove_redis_smember(self.resid, redis_skey_hashes, h)
-                obsolete_tag = get_redis_value(h, redis_hkey_tag)
-                delete_redis_value(h, redis_hkey_site)
-                delete_redis_value(h, redis_hkey_name)
-                delete_redis_value(h, redis_hkey_link)
-                delete_redis_value(h, redis_hkey_parent)
-                delete_redis_value(h, redis_hkey_tag)
-                logger.info('{}: removed: {} {}'.format(self.name, h, obsolete_tag))
+            if len(obsoletes) > 0:
+                tag_pipeline = redis.pipeline(transaction=False)
+                for h in obsoletes:
+                    tag_pipeline.hget(h, redis_hkey_tag)
+                for h, obsolete_tag in zip(obsoletes, tag_pipeline.execute()):
+                    pipeline.hdel(h, redis_hkey_site, redis_hkey_name, redis_hkey_link, redis_hkey_parent, redis_hkey_tag)
+                    logger.info('{}: removed: {} {}'.format(self.name, h, obsolete_tag))
+                pipeline.srem(self.resid + '+' + redis_skey_hashes, *obsoletes)
+
+        # A job retried after a crash updates with the same timestamp again.
+        # The oldest sequence falls off the list, together with its set.
+        if len(updated) == 0 or updated[0] != str(now):
+            pipeline.lpush(self.resid + '+' + redis_lkey_updated, str(now))
+            if len(updated) + 1 > redis_lmax_updated:
+                pipeline.rpop(self.resid + '+' + redis_lkey_updated)
+                pipeline.delete(self.resid + '+' + updated[-1])
+        source.commit(pipeline)
+        pipeline.execute()
+        # A failed fetch says nothing about how often the site changes, so
+        # the site stays due and is tried again on the next run.
+        if link_set is None:
+            logger.info('{}: updated: {}, fetch failed, still due'.format(self.name, now))
+        else:
+            interval = self.reschedule(now, changed, variables)
+            logger.info('{}: updated: {}, next in {:.0f}s'.format(self.name, now, interval))
 
-        add_redis_list_value(self.resid, redis_lkey_updated, str(now), redis_lmax_updated, True)
-        logger.info('{}: updated: {}'.format(self.name, now))
+        return True
+
+    def get_due(self):
+        due = self.values.get(redis_hkey_due) if self.values is not None else get_redis_value(self.resid, redis_hkey_due)
+        return float(due) if due is not None else None
+
+    def is_due(self, now):
+        due = self.get_due()
+        return due is None or due <= now + schedule_slack
+
+    def reschedule(self, now, changed, variables):
+        min_interval = float(variables.get('schedule_min_interval', schedule_min_interval_default))
+        max_interval = float(variables.get('schedule_max_interval', schedule_max_interval_default))
+        if changed:
+            add_redis_list_value(self.resid, redis_lkey_changes, str(now), redis_lmax_changes)
+        interval = get_redis_value(self.resid, redis_hkey_interval)
+        if interval is None:
+            interval = min_interval
+        elif changed:
+            interval = float(interval) * float(variables.get('schedule_speedup', schedule_speedup_default))
+        else:
+            interval = float(interval) * float(variables.get('schedule_backoff', schedule_backoff_default))
+
+        # A site that changes at a steady pace is checked at least twice
+        # between two changes, however long it has been quiet since.
+        changes = sorted(float(c) for c in get_redis_list_values(self.resid, redis_lkey_changes))
+        if len(changes) > 1:
+            gaps = sorted(b - a for a, b in zip(changes, changes[1:]))
+            interval = min(interval, gaps[len(gaps) // 2] / 2)
+
+        interval = min(max(interval, min_interval), max_interval)
+        set_redis_value(self.resid, redis_hkey_interval, interval)
+        set_redis_value(self.resid, redis_hkey_due, now + interval)
+        return interval
+
+    def schedule(self, now):
+        if self.exists == False:
+            print('{}: no such a site'.format(self.name), file=sys.stderr)
+            return False
+
+        due = self.get_due()
+        if due is None:
+            due = now
+        interval = get_redis_value(self.resid, redis_hkey_interval)
+        interval = '{:.0f}'.format(float(interval)) if interval is not None else None
+        changes = get_redis_list_values(self.resid, redis_lkey_changes)
+        changed = datetime.utcfromtimestamp(float(changes[0])).isoformat() if len(changes) > 0 else None
+        state = 'due' if self.is_due(now) else 'waiting'
+        due_isotimestamp = datetime.utcfromtimestamp(due).isoformat()
+        print('{} {} {} {} {} {} {}'.format(self.name, state, due, due_isotimestamp, interval, len(changes), changed))
 
         return True
 
-    def links(self, sequence):
+    def links(self, sequence, references=None):
         if self.exists == False:
             print('{}: no such a site'.format(self.name), file=sys.stderr)
             return False
 
+        if references is None:
+            references = {}
+
+        hashes = None
         if sequence is None:
             hashes = list(get_redis_smembers(self.resid, redis_skey_hashes))
         else:
@@ -592,20 +1224,13 @@ class Site:
         if hashes is not None:
             if debug_mode is True:
                 print('{} hashes {}'.format(self.name, hashes))
-            for h in hashes:
-                n = get_redis_value(h,redis_hkey_name)
-                l = get_redis_value(h, redis_hkey_link)
-                t = get_redis_value(h, redis_hkey_tag)
-                ph = get_redis_value(h, redis_hkey_parent)
-                if ph is None:
-                    pl = None
-                else:
-                    pl = get_redis_value(ph, redis_hkey_link)
-                sh = get_redis_value(h, redis_hkey_site)
-                if sh is None:
-                    sl = None
-                else:
-                    sl = get_redis_value(sh, redis_hkey_link)
+            for h, values in iter_redis_links(hashes, references):
+                n = values.get(redis_hkey_name)
+                l = values.get(redis_hkey_link)
+                ph = values.get(redis_hkey_parent)
+                pl = None if ph is None else references.get(ph)
+                sh = values.get(redis_hkey_site)
+                sl = None if sh is None else references.get(sh)
                 if debug_mode:
                     print('{} {} {} {} {} {} {} {}'.format(self.name, sh, ph, h, sl, pl, l, n))
                 else:
@@ -629,14 +1254,35 @@ class Site:
                 updated_isotimestamp = datetime.utcfromtimestamp(float(updated)).isoformat()
                 print('{} {} {} {} {}'.format(self.name, seq, population, updated, updated_isotimestamp))
 
-    def print(self, sequence, device=None):
+    def get_printed_hkey(self, device):
+        # Each device keeps its own marker, so that printing to one of them
+        # does not use up the notifications of another.
+        return redis_hkey_printed + '+' + (device if device is not None else 'stdout')
+
+    def get_unprinted(self, device):
+        # Every update adds a sequence, so all of them since the last print
+        # are printed, oldest first. A site never printed starts with the
+        # latest one only.
+        updated_list = get_redis_list_values(self.resid, redis_lkey_updated)
+        printed = get_redis_value(self.resid, self.get_printed_hkey(device))
+        if printed is None:
+            return updated_list[:1]
+        return [u for u in reversed(updated_list) if float(u) > float(printed)]
+
+    def print(self, sequence, device=None, unprinted_only=False):
         if self.exists == False:
             print('{}: no such a site'.format(self.name), file=sys.stderr)
             return False
 
-        variables = get_redis_variables(self.resid, override=True)
+        if unprinted_only:
+            updated_list = self.get_unprinted(device)
+            if len(updated_list) == 0:
+                return True
+        else:
+            updated = get_redis_list_value(self.resid, redis_lkey_updated, sequence)
+            updated_list = [updated] if updated is not None else []
 
-        updated = get_redis_list_value(self.resid, redis_lkey_updated, sequence)
+        variables = get_redis_variables(self.resid, override=True)
 
         module = None
         printer = None
@@ -648,14 +1294,13 @@ class Site:
                 interface = device_parsed[0]
                 if len(device_parsed) > 1 and len(device_parsed[1]) > 0:
                     args = device_parsed[1]
-        try:
-            module = import_module('.if' + interface, f'{__package__}.interfaces')
-        except ModuleNotFoundError as e:
+        module = get_interface(interface)
+        if module is None or not hasattr(module, 'Printer'):
             print('{}: {} is not a printer device'.format(self.name, interface), file=sys.stderr)
             return False
         printer = module.Printer(args, variables)
 
-        if updated is not None:
+        for updated in updated_list:
             hashes = list(get_redis_smembers(self.resid, updated))
             if debug_mode is True:
                 updated_isotimestamp = datetime.utcfromtimestamp(float(updated)).isoformat()
@@ -668,10 +1313,10 @@ class Site:
                     'link': get_redis_value(self.resid, redis_hkey_link),
                     'hashes': {}
                 }
-                for h in hashes:
-                    tag = get_redis_value(h, redis_hkey_tag)
-                    text = get_redis_value(h, redis_hkey_name)
-                    link = get_redis_value(h, redis_hkey_link)
+                for h, values in iter_redis_links(hashes):
+                    tag = values.get(redis_hkey_tag)
+                    text = values.get(redis_hkey_name)
+                    link = values.get(redis_hkey_link)
                     if tag is None:
                         tag = 'obsolete'
                     targets['hashes'].update({
@@ -683,6 +1328,12 @@ class Site:
                     })
                 if len(targets['hashes']) > 0:
                     printer.print_all(targets, debug_mode)
+            # Marked only once the printer returned, so that a sequence whose
+            # notification failed is printed again next time.
+            if unprinted_only:
+                set_redis_value(self.resid, self.get_printed_hkey(device), updated)
+
+        return True
 
     @classmethod
     def global_config(cls, linkv, filetypev, depthv, ignoresv, recognizev):
@@ -692,10 +1343,17 @@ class Site:
 
         if ignoresv is not None:
             for i in ignoresv:
+                error = get_rule_error(i)
+                if error is not None:
+                    print('global: cannot ignore {}: {}'.format(i, error), file=sys.stderr)
+                    continue
                 add_redis_ignores(i)
         if recognizev is not None:
             for r in recognizev:
                 remove_redis_ignores(r)
+        if ignoresv is not None or recognizev is not None:
+            for resid in get_redis_registry().values():
+                delete_redis_set(resid, redis_skey_pages)
 
         for i in get_redis_ignores():
             print('global ignores {}'.format(i))
@@ -706,8 +1364,12 @@ class Site:
             set_redis_global_variable(var, val)
         else:
             delete_redis_global_variable(var)
+        for resid in get_redis_registry().values():
+            delete_redis_set(resid, redis_skey_pages)
 
         print('global {} {}'.format(var, val))
+        if var in hash_changing_variables:
+            print('global: {}: {}'.format(var, hash_changing_variables[var]), file=sys.stderr)
 
     @classmethod
     def global_print_variable(cls):
@@ -716,7 +1378,12 @@ class Site:
             print('global {} {}'.format(k, v))
 
     @classmethod
-    def export_data(cls):
+    def export_data(cls, format='json'):
+        if format == 'ndjson':
+            for record in iter_redis_data():
+                print(json.dumps(record, ensure_ascii=False))
+            return
+
         data = dump_redis_data()
         if data is None:
             print('no data to export', file=sys.stderr)
@@ -724,112 +1391,289 @@ class Site:
             print(json.dumps(data, ensure_ascii=False, indent=1))
 
     @classmethod
-    def import_data(cls):
-        if is_redis_empty() == False:
+    def import_data(cls, batch_size=1000, merge=False):
+        if is_redis_empty() == False and not merge:
             print('database is not empty', file=sys.stderr)
+            return
+
+        # An NDJSON export starts with a complete record on its first line,
+        # while a JSON export starts with an opening brace.
+        stream = sys.stdin.buffer
+        first = stream.readline()
+        if len(first.strip()) == 0:
+            print('no data to import', file=sys.stderr)
+            return
+        try:
+            record = json.loads(first)
+        except ValueError:
+            record = None
+        if isinstance(record, dict) and json_section_type in record:
+            records = iter_ndjson_records(itertools.chain([first], stream))
         else:
-            data = json.loads(sys.stdin.read())
-            if data is None:
-                print('no data to import', file=sys.stderr)
-            else:
-                count = load_redis_data(data)
-                print('{} sites imported'.format(count), file=sys.stderr)
+            records = iter_document_records(ChainedReader(first, stream))
+        count = load_redis_records(records, batch_size, merge)
+        print('{} sites imported'.format(count), file=sys.stderr)
 
 class SiteList:
 
     def __init__(self, name_template=None, strict=False):
         self.site_name_list = []
+        self.sites = []
         self.global_op = False
-        if name_template is None:
-            self.site_name_list = sorted(list(get_redis_names()))
+        if name_template is not None and name_template.lower() == 'global':
+            self.global_op = True
+            return
+
+        registry = get_redis_registry()
+        all_name_list = sorted(registry)
+        if name_template is None or name_template.lower() == 'all':
+            self.site_name_list = all_name_list
         else:
             name_template_lower = name_template.lower()
-            if name_template_lower == 'all':
-                self.site_name_list = sorted(list(get_redis_names()))
-            elif name_template_lower == 'global':
-                self.global_op = True
+            if strict is True:
+                if name_template_lower in all_name_list:
+                    self.site_name_list = [ name_template_lower ]
             else:
-                all_name_list = sorted(list(get_redis_names()))
-                if strict is True:
-                    if name_template_lower in all_name_list:
-                        self.site_name_list = [ name_template_lower ]
-                else:
-                    re_pattern = re.compile(name_template_lower, re.IGNORECASE)
-                    name_list = []
-                    for s in all_name_list:
-                        if re_pattern.search(s):
-                            name_list.append(s)
-                    self.site_name_list = name_list
+                re_pattern = re.compile(name_template_lower, re.IGNORECASE)
+                name_list = []
+                for s in all_name_list:
+                    if re_pattern.search(s):
+                        name_list.append(s)
+                self.site_name_list = name_list
+
+        for s, (resid, values, variables) in zip(self.site_name_list, get_redis_sites(registry, self.site_name_list)):
+            self.sites.append(Site(s, resid, values, variables))
 
     def list(self):
-        for s in self.site_name_list:
-            resid = get_redis_resid(s)
-            name = get_redis_value(resid, redis_hkey_name)
-            link = get_redis_value(resid, redis_hkey_link)
-            filetype = get_redis_value(resid, redis_hkey_filetype)
-            depth = get_redis_value(resid, redis_hkey_depth)
+        for site in self.sites:
+            name = site.values.get(redis_hkey_name)
+            link = site.values.get(redis_hkey_link)
+            filetype = site.values.get(redis_hkey_filetype)
+            depth = site.values.get(redis_hkey_depth)
             if debug_mode is True:
-                print('{} {} {} {} {}'.format(resid, name, link, filetype, depth))
+                print('{} {} {} {} {}'.format(site.resid, name, link, filetype, depth))
             else:
                 print('{} {} {} {}'.format(name, link, filetype, depth))
 
     def config(self, linkv=None, filetypev=None, depthv=None, ignoresv=None, recognizev=None):
         if self.global_op == True:
-            Site.global_config(args.link, args.filetype, args.depth, args.ignores, args.remove_ignores)
+            Site.global_config(linkv, filetypev, depthv, ignoresv, recognizev)
         else:
-            for s in self.site_name_list:
-                resid = get_redis_resid(s)
-                name = get_redis_value(resid, redis_hkey_name)
-                Site(name).config(linkv, filetypev, depthv, ignoresv, recognizev)
+            for site in self.sites:
+                site.config(linkv, filetypev, depthv, ignoresv, recognizev)
 
     def set_variable(self, var, val):
         if self.global_op == True:
             Site.global_set_variable(var, val)
         else:
-            for s in self.site_name_list:
-                resid = get_redis_resid(s)
-                name = get_redis_value(resid, redis_hkey_name)
-                Site(name).set_variable(var, val)
+            for site in self.sites:
+                site.set_variable(var, val)
 
     def print_variables(self):
         if self.global_op == True:
             Site.global_print_variable()
         else:
-            for s in self.site_name_list:
-                resid = get_redis_resid(s)
-                name = get_redis_value(resid, redis_hkey_name)
-                Site(name).print_variables()
+            for site in self.sites:
+                site.print_variables()
 
-    def update(self):
+    def update(self, jobs=1, due_only=False):
         now = time.time()
-        for s in self.site_name_list:
-            resid = get_redis_resid(s)
-            name = get_redis_value(resid, redis_hkey_name)
-            Site(name).update(now)
+        sites = self.sites
+        if due_only:
+            sites = [site for site in sites if site.is_due(now)]
+            waiting = len(self.sites) - len(sites)
+            if waiting > 0:
+                print('{} sites not due yet'.format(waiting), file=sys.stderr)
+                logger.info('{} sites not due yet'.format(waiting))
+
+        global_ignores = compile_ignores(get_redis_ignores())
+
+        def update_site(site):
+            started = time.time()
+            try:
+                site.update(now, global_ignores)
+            except Exception as e:
+                print('{}: failed to update'.format(site.name), file=sys.stderr)
+                logger.exception('{}: failed to update'.format(site.name))
+            return site.name, time.time() - started, site.pages_unchanged
+
+        # The redis client and the logger are shared by all workers; both are
+        # thread-safe, and each Site only touches its own keys.
+        started = time.time()
+        if jobs > 1 and len(sites) > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                elapsed = list(executor.map(update_site, sites))
+        else:
+            elapsed = [update_site(site) for site in sites]
+
+        for name, seconds, unchanged in sorted(elapsed, key=lambda e: e[1], reverse=True):
+            print('{}: {:.3f}s'.format(name, seconds), file=sys.stderr)
+            logger.info('{}: update took {:.3f}s'.format(name, seconds))
+        pages_unchanged = sum(e[2] for e in elapsed)
+        print('{} sites updated in {:.3f}s, {} unchanged pages skipped'.format(len(elapsed), time.time() - started, pages_unchanged), file=sys.stderr)
+        logger.info('{} unchanged pages skipped'.format(pages_unchanged))
 
-    def print(self, sequence, device):
-        for s in self.site_name_list:
-            resid = get_redis_resid(s)
-            name = get_redis_value(resid, redis_hkey_name)
-            Site(name).print(sequence,device)
+    def print(self, sequence, device, unprinted_only=False):
+        for site in self.sites:
+            site.print(sequence, device, unprinted_only)
 
     def links(self, sequence):
-        for s in self.site_name_list:
-            resid = get_redis_resid(s)
-            name = get_redis_value(resid, redis_hkey_name)
-            Site(name).links(sequence)
+        references = {}
+        for site in self.sites:
+            site.links(sequence, references)
 
     def sequences(self):
-        for s in self.site_name_list:
-            resid = get_redis_resid(s)
-            name = get_redis_value(resid, redis_hkey_name)
-            Site(name).sequences()
+        for site in self.sites:
+            site.sequences()
+
+    def enqueue(self, method, due_only=False):
+        now = time.time()
+        queued = 0
+        skipped = 0
+        for site in self.sites:
+            if due_only and not site.is_due(now):
+                continue
+            if enqueue_redis_job(method, site.name, site.resid, now):
+                queued += 1
+            else:
+                skipped += 1
+        print('{} jobs queued, {} already queued'.format(queued, skipped), file=sys.stderr)
+        logger.info('{} jobs queued, {} already queued'.format(queued, skipped))
+
+    def schedule(self):
+        now = time.time()
+        for site in sorted(self.sites, key=lambda site: site.get_due() or now):
+            site.schedule(now)
+
+def serve(name, strict, jobs, due_only, update_interval, print_interval, device, timestamp):
+    import signal
+    from sitewatcher import httpclient
+
+    stopped = threading.Event()
+    reloaded = threading.Event()
+
+    def stop(signum, frame):
+        logger.warning('serve: signal {} received, stopping'.format(signum))
+        stopped.set()
+
+    def reload(signum, frame):
+        reloaded.set()
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    def run(method, cycle):
+        if timestamp:
+            now_isotimestamp = datetime.utcfromtimestamp(time.time()).isoformat()
+            print(f'# {method} {now_isotimestamp}', file=sys.stderr)
+        try:
+            cycle()
+        except Exception as e:
+            print('serve: {} failed'.format(method), file=sys.stderr)
+            logger.exception('serve: {} failed'.format(method))
+
+    # Site lists are rebuilt on every cycle so that sites added or removed
+    # while serving are picked up; the redis and HTTP pools stay open.
+    logger.warning('serve: started, update every {}s, print every {}s'.format(update_interval, print_interval))
+    next_update = time.monotonic()
+    next_print = time.monotonic()
+    while True:
+        if reloaded.is_set():
+            reloaded.clear()
+            stopped.clear()
+            httpclient.configure(get_redis_global_variables(), redis)
+            logger.warning('serve: configuration reloaded')
+        if stopped.is_set():
+            break
+
+        if time.monotonic() >= next_update:
+            run('update', lambda: SiteList(name, strict).update(jobs, due_only))
+            next_update = max(next_update + update_interval, time.monotonic())
+        if not stopped.is_set() and time.monotonic() >= next_print:
+            run('print', lambda: SiteList(name, strict).print('0', device, True))
+            next_print = max(next_print + print_interval, time.monotonic())
+
+        stopped.wait(max(min(next_update, next_print) - time.monotonic(), 0))
+
+    logger.warning('serve: stopped')
+    return 0
+
+def worker(jobs, visibility, once):
+    import signal
+
+    worker_id = '{}:{}'.format(socket.gethostname(), os.getpid())
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        logger.warning('worker {}: signal {} received, stopping'.format(worker_id, signum))
+        stopped.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def run_jobs():
+        while not stopped.is_set():
+            job = claim_redis_job(visibility)
+            if job is None:
+                if once:
+                    return
+                stopped.wait(queue_poll_interval)
+                continue
+
+            if job['attempts'] > queue_max_attempts:
+                print('{}: {} given up after {} attempts'.format(job['name'], job['method'], queue_max_attempts), file=sys.stderr)
+                logger.error('{}: {} given up after {} attempts'.format(job['name'], job['method'], queue_max_attempts))
+                complete_redis_job(job)
+                continue
+
+            succeeded = False
+            try:
+                if job['method'] == 'update':
+                    succeeded = Site(job['name']).update(job['now']) != False
+            except Exception as e:
+                print('{}: failed to update'.format(job['name']), file=sys.stderr)
+                logger.exception('{}: failed to update'.format(job['name']))
+            if succeeded:
+                complete_redis_job(job)
+            else:
+                release_redis_job(job)
+            count_redis_worker_job(worker_id, succeeded)
+
+    logger.warning('worker {}: started with {} jobs'.format(worker_id, jobs))
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for f in [executor.submit(run_jobs) for i in range(jobs)]:
+                f.result()
+    else:
+        run_jobs()
+    logger.warning('worker {}: stopped'.format(worker_id))
+    return 0
+
+def print_queue():
+    now = time.time()
+    pending = redis.zcount(get_redis_queue_key(), '-inf', now)
+    inflight = redis.zcount(get_redis_queue_key(), '({}'.format(now), '+inf')
+    print('queue {} pending {} in-flight or waiting to retry'.format(pending, inflight))
+    for worker_id in sorted(redis.smembers(get_redis_queue_key(redis_skey_workers))):
+        stats = redis.hgetall(get_redis_queue_key(redis_skey_worker + '+' + worker_id))
+        if len(stats) == 0:
+            redis.srem(get_redis_queue_key(redis_skey_workers), worker_id)
+            continue
+        done = int(stats.get('done', 0))
+        failed = int(stats.get('failed', 0))
+        elapsed = float(stats['seen']) - float(stats['started'])
+        rate = done * 3600 / elapsed if elapsed > 0 else 0
+        seen_isotimestamp = datetime.utcfromtimestamp(float(stats['seen'])).isoformat()
+        print('worker {} {} done {} failed {:.1f}/h {}'.format(worker_id, done, failed, rate, seen_isotimestamp))
 
 def main():
 
     global redis
     global logger
     global debug_mode
+    global title_cache_enabled
 
     redis_host = os.environ.get('REDIS_HOST', 'localhost')
     redis_port = os.environ.get('REDIS_PORT', '6379')
@@ -851,6 +1695,7 @@ def main():
     parser = argparse.ArgumentParser(description='Check updating of web sites', formatter_class=SortingHelpFormatter)
     parser.add_argument('--debug', action='store_true', help='debug output')
     parser.add_argument('--timestamp', action='store_true', help='print timestamp to /dev/stderr')
+    parser.add_argument('--startup-profile', action='store_true', help='print startup and command time to /dev/stderr')
 
     sps = parser.add_subparsers(dest='subparser_name', title='action arguments')
     sp_add = sps.add_parser('add', help='add a site')
@@ -869,7 +1714,7 @@ def main():
     sp_config.add_argument('--link', '-l', nargs=1, metavar='URL', help='link')
     sp_config.add_argument('--filetype', '-f', nargs=1, metavar='(CSV,RSS)', help='file type (NONE to remove)')
     sp_config.add_argument('--depth', '-d', nargs=1, metavar='N', help='depth')
-    sp_config.add_argument('--ignores', '-i', action='append', metavar='URL', help='add to ignore list')
+    sp_config.add_argument('--ignores', '-i', action='append', metavar='URL', help='add to ignore list (URL prefix, host:HOST or re:REGEX)')
     sp_config.add_argument('--remove-ignores', '-r', action='append', metavar='URL', help='remove from ignore list')
     sp_set = sps.add_parser('set', help='set a variable')
     sp_set.add_argument('name', nargs=1, metavar='NAME', help='site name (or \'all\', \'global\')')
@@ -886,6 +1731,9 @@ def main():
     sp_update = sps.add_parser('update', help='update sites')
     sp_update.add_argument('name', nargs=1, metavar='NAME', help='site name (or \'all\')')
     sp_update.add_argument('--strict', action='store_true', help='strict name check')
+    sp_update.add_argument('--jobs', '-j', default='1', metavar='N', help='number of sites updated concurrently')
+    sp_update.add_argument('--no-title-cache', action='store_true', help='resolve titles without the title cache')
+    sp_update.add_argument('--due-only', action='store_true', help='update only sites whose next check is due')
     sp_links = sps.add_parser('links', help='print all links')
     sp_links.add_argument('name', nargs=1, metavar='NAME', help='site name (or \'all\')')
     sp_links.add_argument('--strict', action='store_true', help='strict name check')
@@ -894,15 +1742,40 @@ def main():
     sp_print.add_argument('name', nargs=1, metavar='NAME', help='site name (or \'all\')')
     sp_print.add_argument('--strict', action='store_true', help='strict name check')
     sp_print.add_argument('--sequence', '-s', default='0', metavar='N', help='time sequence number (0-9, latest=0 by deafult)')
+    sp_print.add_argument('--unprinted', action='store_true', help='print every sequence not printed to the device yet')
     sp_print.add_argument('--device', '-d', nargs=1, metavar='DEVICE', help='device information like DEVICE:ARGUMENT')
     sp_sequences = sps.add_parser('sequences', help='list time sequences')
     sp_sequences.add_argument('name', nargs=1, metavar='NAME', help='site name (or \'all\')')
     sp_sequences.add_argument('--strict', action='store_true', help='strict name check')
+    sp_schedule = sps.add_parser('schedule', help='list next checks of sites')
+    sp_schedule.add_argument('name', nargs=1, metavar='NAME', help='site name (or \'all\')')
+    sp_schedule.add_argument('--strict', action='store_true', help='strict name check')
+    sp_serve = sps.add_parser('serve', help='update and print sites periodically')
+    sp_serve.add_argument('name', nargs='?', default='all', metavar='NAME', help='site name (\'all\' by default)')
+    sp_serve.add_argument('--strict', action='store_true', help='strict name check')
+    sp_serve.add_argument('--jobs', '-j', default='1', metavar='N', help='number of sites updated concurrently')
+    sp_serve.add_argument('--due-only', action='store_true', help='update only sites whose next check is due')
+    sp_serve.add_argument('--update-interval', default=str(serve_update_interval_default), metavar='SECONDS', help='seconds between update cycles')
+    sp_serve.add_argument('--print-interval', default=str(serve_print_interval_default), metavar='SECONDS', help='seconds between print cycles')
+    sp_serve.add_argument('--device', '-d', nargs=1, metavar='DEVICE', help='device information like DEVICE:ARGUMENT')
+    sp_enqueue = sps.add_parser('enqueue', help='queue jobs for workers')
+    sp_enqueue.add_argument('method', nargs=1, choices=['update'], help='job')
+    sp_enqueue.add_argument('name', nargs=1, metavar='NAME', help='site name (or \'all\')')
+    sp_enqueue.add_argument('--strict', action='store_true', help='strict name check')
+    sp_enqueue.add_argument('--due-only', action='store_true', help='queue only sites whose next check is due')
+    sp_worker = sps.add_parser('worker', help='run queued jobs')
+    sp_worker.add_argument('--jobs', '-j', default='1', metavar='N', help='number of jobs run concurrently')
+    sp_worker.add_argument('--visibility', default=str(queue_visibility_default), metavar='SECONDS', help='seconds before a job of a lost worker is retried')
+    sp_worker.add_argument('--once', action='store_true', help='exit when the queue is empty')
+    sp_queue = sps.add_parser('queue', help='print queue and worker statistics')
     sp_list = sps.add_parser('list', help='list sites')
     sp_list.add_argument('name', nargs=1, metavar='NAME', help='site name (or \'all\')')
     sp_list.add_argument('--strict', action='store_true', help='strict name check')
     sp_export = sps.add_parser('export', help='export database')
+    sp_export.add_argument('--format', default='json', choices=['json', 'ndjson'], help='json document or one record per line')
     sp_import = sps.add_parser('import', help='import database')
+    sp_import.add_argument('--batch', default='1000', metavar='N', help='number of records written per pipeline')
+    sp_import.add_argument('--merge', action='store_true', help='import into a database that is not empty')
 
     if len(sys.argv) == 1:
         print(parser.format_usage(), file=sys.stderr)
@@ -931,6 +1804,17 @@ def main():
 
     redis = Redis(host=redis_host, port=redis_port, decode_responses=True)
 
+    if args.startup_profile:
+        startup_modules = set(m.split('.')[0] for m in sys.modules)
+        print('# startup imports {:.1f}ms, {} packages loaded'.format(imports_seconds * 1000, len(startup_modules)), file=sys.stderr)
+        command_started = time.perf_counter()
+
+    if method in ['update', 'print', 'serve', 'worker']:
+        from sitewatcher import httpclient
+        httpclient.configure(get_redis_global_variables(), redis)
+
+    status = 0
+
     if method == 'add':
         Site(args.name[0]).add(args.link[0], args.filetype, int(args.depth))
     elif method == 'delete':
@@ -946,22 +1830,38 @@ def main():
     elif method == 'variables':
         SiteList(args.name[0], args.strict).print_variables()
     elif method == 'update':
-        SiteList(args.name[0], args.strict).update()
+        title_cache_enabled = not args.no_title_cache
+        SiteList(args.name[0], args.strict).update(int(args.jobs), args.due_only)
     elif method == 'links':
         SiteList(args.name[0], args.strict).links(args.sequence)
     elif method == 'print':
         device = None if args.device is None else args.device[0]
-        SiteList(args.name[0], args.strict).print(args.sequence, device)
+        SiteList(args.name[0], args.strict).print(args.sequence, device, args.unprinted)
     elif method == 'sequences':
         SiteList(args.name[0], args.strict).sequences()
+    elif method == 'serve':
+        device = None if args.device is None else args.device[0]
+        status = serve(args.name, args.strict, int(args.jobs), args.due_only, float(args.update_interval), float(args.print_interval), device, args.timestamp)
+    elif method == 'enqueue':
+        SiteList(args.name[0], args.strict).enqueue(args.method[0], args.due_only)
+    elif method == 'worker':
+        status = worker(int(args.jobs), float(args.visibility), args.once)
+    elif method == 'queue':
+        print_queue()
+    elif method == 'schedule':
+        SiteList(args.name[0], args.strict).schedule()
     elif method == 'list':
         SiteList(args.name[0], args.strict).list()
     elif method == 'export':
-        Site.export_data()
+        Site.export_data(args.format)
     elif method == 'import':
-        Site.import_data()
+        Site.import_data(int(args.batch), args.merge)
 
-    return 0
+    if args.startup_profile:
+        command_modules = sorted(set(m.split('.')[0] for m in sys.modules) - startup_modules)
+        print('# {} {:.1f}ms, {} packages loaded: {}'.format(method, (time.perf_counter() - command_started) * 1000, len(command_modules), ' '.join(command_modules)), file=sys.stderr)
+
+    return status
 
 if __name__ == '__main__':
     exit(main())
@@ -0,0 +1,97 @@
+import logging
+import os
+import unittest
+from bs4 import BeautifulSoup
+
+from sitewatcher.ignores import compile_ignores
+from sitewatcher.interfaces import ifhtml
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+fixture_link = 'https://example.com/portal/index.html'
+
+# Output of get_references before the parser backend was made selectable,
+# as (hash, name, link) in insertion order. Hashes are stored link hashes,
+# so any difference here makes live sites report links again.
+baseline_references = [
+    ('35daaaa33e8a9078267c51ae2c90a447', 'Home', 'https://example.com/'),
+    ('1165200c3291382bbc9a0d2115e183bc', 'First news', 'https://example.com/portal/news/1.html'),
+    ('54a708f7a1e404ceaee61022a00cf60b', 'Second news::(update)', 'https://example.com/portal/news/2.html'),
+    ('4fcb33b3ed3b74579061cfe6cb7186f8', 'Third news', 'https://example.com/portal/news/3.html'),
+    ('e87c2512a2eb9e8ef4fe0924a905b547', 'Fourth news with a long title', 'https://example.com/portal/news/4.html'),
+    ('0954dae5e8f6d33546222bd90cf5a6cf', 'Fifth', 'https://example.com/portal/news/5.html'),
+    ('c3a34be313d970ecbdc74c6c8b21a58b', 'Sixth', 'https://example.com/portal/news/6.html'),
+    ('942034ff260a63198f4145cb9e515a04', 'Seventh', 'https://example.com/portal/news/7.html'),
+    ('3e4c48af9e4b8302703588439a29aa10', 'Advertisement', 'https://ads.example.com/banner'),
+    ('af53c9269b22d3085097a76130a158bc', 'Advertisement again', 'https://ADS.example.com/other'),
+    ('ce0eba248a834fd98de8918bd235828f', 'Report::2021::(PDF)', 'https://example.com/portal/doc/report.pdf'),
+    ('4bee7b9d275554128340f088d413186b', 'External', 'https://other.example.org/path?q=1#frag'),
+    ('597448ac2e9284d5571686fc53e2467a', 'outer::inner::tail', 'https://example.com/x'),
+    ('6fcad04b995ee9098e80ff6aba6a132b', 'inner', 'https://example.com/y'),
+    ('e11a4efe9abff4c5a50ad1b50163024f', 'In a::table', 'https://example.com/portal/table.html')
+]
+
+def get_baseline(ignored=()):
+    return [
+        (h, { 'site': 'resid', 'parent': 'parent', 'name': n, 'link': l, 'tag': n + ' ---- ' + l })
+        for h, n, l in baseline_references
+        if not l.lower().startswith(ignored)
+    ]
+
+class TestGetReferences(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(fixtures_dir, 'references.html'), 'rb') as f:
+            self.content = f.read()
+        self.source = ifhtml.Source('fixture', 'resid', logging.getLogger())
+
+    def get_references(self, ignores=None, backend=None):
+        bs = self.source.make_soup(self.content, backend)
+        return list(self.source.get_references(bs, 'parent', fixture_link, None, ignores).items())
+
+    def test_default_backend_matches_baseline(self):
+        self.assertEqual(self.get_references(), get_baseline())
+
+    def test_fixture_is_parsed_strained(self):
+        self.assertTrue(ifhtml.is_strainable(self.content))
+        self.assertEqual(len(self.source.make_soup(self.content).find_all('p')), 0)
+
+    def test_full_tree_matches_baseline(self):
+        bs = BeautifulSoup(self.content, 'html.parser')
+        self.assertEqual(list(self.source.get_references(bs, 'parent', fixture_link, None, None).items()), get_baseline())
+
+    def test_html_parser_backend_matches_baseline(self):
+        self.source.variables = { 'html_parser': 'html.parser' }
+        self.assertEqual(self.get_references(), get_baseline())
+
+    def test_unknown_backend_falls_back_to_default(self):
+        self.source.variables = { 'html_parser': 'unknown' }
+        self.assertEqual(self.get_references(), get_baseline())
+
+    def test_ignores_match_baseline(self):
+        ignores = compile_ignores(['https://ads.example.com'])
+        self.assertEqual(self.get_references(ignores), get_baseline(('https://ads.example.com',)))
+
+class TestStrainable(unittest.TestCase):
+
+    documents = [
+        b'<ul><li><a href="/a">one<li><a href="/b">two</ul><a href="/c">three',
+        b'<table><tr><td><a href="/t">cell</td><td>x</td></tr></table><a href="/u">u</a>',
+        b'<td><a href="/t">cell<script>"</a>"</script></td><td>x</td><a href="/u">u</a>',
+        b'<a href="/p"><b>bold</a> after</b> <a href="/q">q</a>',
+        b'<!-- <a href="/c">commented</a> --><a href="/q">q<br/>r</a>'
+    ]
+
+    def test_unclosed_anchors_match_full_tree(self):
+        source = ifhtml.Source('fixture', 'resid', logging.getLogger())
+        for content in self.documents:
+            expected = source.get_references(BeautifulSoup(content, 'html.parser'), 'parent', fixture_link, None, None)
+            actual = source.get_references(source.make_soup(content), 'parent', fixture_link, None, None)
+            self.assertEqual(list(actual.items()), list(expected.items()), content)
+
+    def test_anchor_closed_by_enclosing_element_is_not_strainable(self):
+        self.assertFalse(ifhtml.is_strainable(b'<td><a href="/t">cell</td>'))
+        self.assertFalse(ifhtml.is_strainable(b'<td><a href="/t">cell<script>"</a>"</script></td>'))
+        self.assertTrue(ifhtml.is_strainable(b'<td><a href="a>b" title=\'</td>\'>cell</a></td>'))
+
+if __name__ == '__main__':
+    unittest.main()